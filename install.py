@@ -12,6 +12,11 @@ os.chmod('mirp/mirp_pf_sorting', stat.S_IRWXU)
 os.chmod('mirp/mirp_initial_seam', stat.S_IRWXU)
 os.chmod('mirp/mirp_seam_check', stat.S_IRWXU)
 os.chmod('mirp/plot_eulerxy.py', stat.S_IRWXU)
+os.chmod('mirp/benchmark_startup.py', stat.S_IRWXU)
+os.chmod('mirp/check_equivalence.py', stat.S_IRWXU)
+os.chmod('mirp/mirp_shard', stat.S_IRWXU)
+os.chmod('mirp/mirp_merge', stat.S_IRWXU)
+os.chmod('mirp/mirp_server', stat.S_IRWXU)
 
 home = os.environ['HOME']
 cwd = os.getcwd()
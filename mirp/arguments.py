@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+arguments.py provides the command line options shared by several MiRP scripts (plotting, watching a running job, and
+memory use), so that each is defined, with its help, in one place.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+#add the options for per-microtubule contact sheets. condition (e.g. '-o') is an option that plots are only saved with
+def add_plot_arguments(parser, condition=None):
+    save = 'With %s, save' % condition if condition else 'Save'
+    parser.add_argument('--compact_plots', required=False, choices=['png', 'pdf'], help='%s per-microtubule plots as compact rasterised contact sheets in this format, instead of one vector PDF page per microtubule.' % save)
+    parser.add_argument('--plot_grid', required=False, type=int, default=6, help='Number of microtubules per row and column of each contact sheet. Default 6.')
+    parser.add_argument('--plot_dpi', required=False, type=int, default=60, help='Resolution of contact sheets. Default 60.')
+    parser.add_argument('--plot_max_mb', required=False, type=float, help='Stop writing contact sheets once each plot output reaches this size (MB).')
+
+#the options given by add_plot_arguments, as keyword arguments of Microtubules.set_plot_options, or None without --compact_plots
+def plot_options(args):
+    if not args.compact_plots:
+        return None
+    return {'fmt': args.compact_plots, 'grid': args.plot_grid, 'dpi': args.plot_dpi, 'max_mb': args.plot_max_mb}
+
+#add the options for following a running job (see watch.watch_job). job describes the job followed, and note is added to the
+#help of --watch
+def add_watch_arguments(parser, job='Class3D', note=''):
+    parser.add_argument('--watch', required=False, help='Instead of -i, follow a running %s job directory, and vote on each iteration as it is written.%s' % (job, note))
+    parser.add_argument('--poll', required=False, type=float, default=5, help='With --watch, seconds between checks for new iterations. Default 5.')
+    parser.add_argument('--timeout', required=False, type=float, help='With --watch, stop if no new iteration is written for this many seconds. Default is to stop when the Class3D job finishes.')
+
+#add --max_memory, for sorting with external_sort. then says how the sorted particles are used
+def add_max_memory_argument(parser, then):
+    parser.add_argument('--max_memory', required=False, type=float, help='Sort particles with an external merge sort using temporary files, holding at most about this much unsorted data in memory (MB), then %s. For inputs too large to hold in memory.' % then)
+
+#the --max_memory option in bytes, or None if it is not given
+def max_memory(args):
+    return args.max_memory * 1024**2 if args.max_memory else None
+
+#add the memory and pipelining options of Microtubules (max_memory, pipeline and compact)
+def add_memory_arguments(parser):
+    add_max_memory_argument(parser, 'vote on them one micrograph at a time (or in --pipeline chunks)')
+    parser.add_argument('--pipeline', required=False, type=int, help='Vote on chunks of at least this many microtubules at a time, while the next chunk is read and finished chunks are written in background threads. Input not already sorted by micrograph, microtubule and track length is first read in full and sorted (in bounded memory with --max_memory). Output is the same as without --pipeline.')
+    parser.add_argument('--compact', required=False, action='store_true', help='Store angles, shifts, class numbers and tube IDs as float32/int16/int32 arrays, roughly halving memory for large inputs. Angles and shifts that are not changed are written with a relative error of at most 1.2e-7. Can not be used with --pipeline or --max_memory, which do not hold all particles in memory.')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+Measures the start-up (import) time of the MiRP modules and command line scripts, and checks that heavy
+libraries (NumPy, SciPy, matplotlib) are not imported until they are needed. Exits with a non-zero
+status if a module takes longer than --max_ms to import, or pulls in a heavy library at import time.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import argparse
+import subprocess
+import statistics
+import sys
+import os
+import time
+
+mirp_dir = os.path.dirname(os.path.abspath(__file__))
+modules = ['helper_fns', 'starfileIO', 'microtubules']
+scripts = ['mirp_pf_sorting', 'mirp_initial_seam', 'mirp_seam_check', 'plot_eulerxy.py']
+heavy = ['numpy', 'scipy', 'matplotlib']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', required=False, type=int, default=5, help='Number of repeats per measurement (median is reported). Default 5.')
+parser.add_argument('--max_ms', required=False, type=float, help='Fail if the median import time of any module exceeds this (milliseconds).')
+args = parser.parse_args()
+
+env = dict(os.environ)
+env['PYTHONPATH'] = mirp_dir + os.pathsep + env.get('PYTHONPATH', '')
+env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+#time a fresh interpreter running the given command, returning the median wall time in milliseconds
+def time_command(cmd):
+    times = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+failed = False
+baseline = time_command([sys.executable, '-c', 'pass'])
+print('Interpreter start-up: %.1f ms' % baseline)
+
+print('\nModule import times (excluding interpreter start-up):')
+for mod in modules:
+    ms = time_command([sys.executable, '-c', 'import %s' % mod]) - baseline
+    check = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (mod, heavy)
+    loaded = subprocess.run([sys.executable, '-c', check], env=env, stdout=subprocess.PIPE, check=True).stdout.decode().split()
+    status = 'ok'
+    if loaded:
+        status = 'FAIL (imported %s at start-up)' % ', '.join(loaded)
+        failed = True
+    elif args.max_ms is not None and ms > args.max_ms:
+        status = 'FAIL (over %.1f ms)' % args.max_ms
+        failed = True
+    print('  %-16s %8.1f ms  %s' % (mod, ms, status))
+
+print('\nScript start-up times for --help (excluding interpreter start-up):')
+for script in scripts:
+    ms = time_command([sys.executable, os.path.join(mirp_dir, script), '--help']) - baseline
+    print('  %-22s %8.1f ms' % (script, ms))
+
+if failed:
+    sys.exit(1)
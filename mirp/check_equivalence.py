@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+Checks that the voting in microtubules.py gives the same results as the frozen pure Python reference (reference.py), and
+measures how much faster it is. Each vote (protofilament number, Rot, X/Y and seam) is run by the reference and by
+Microtubules in each of its modes (in memory, pipelined, streamed with max_memory, and compact), on a synthetic dataset and
+on any starfiles given with -i. Output starfiles are compared microtubule by microtubule: the same microtubules must be
+kept, with the same labels in the same order, and the same values (numbers to within a tolerance). The confidence values of
+each vote, and the smoothing, clustering and seam mapping functions the votes are built on, are compared too, as are
+protofilament number votes on microtubules exported to Arrow and pandas (with pyarrow and pandas installed) and read back.
+Vote times include reading the input, and writing the output starfiles and summary plots, but not the progress bar
+Microtubules writes to run.out (the reference has none). Votes and functions slower than the reference are flagged with a
+warning. Exits with a non-zero status if there are any differences (or, with --fail_slower, anything slower).
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+import microtubules
+import reference
+import starfileIO
+import helper_fns
+import collections
+import importlib
+import argparse
+import tempfile
+import shutil
+import random
+import glob
+import math
+import time
+import sys
+import os
+
+STAGES = ['pf', 'rot', 'xy', 'seam']
+MODES = ['default', 'pipeline', 'streamed', 'compact']
+LABELS = ['rlnImageName', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst', 'rlnClassNumber',
+          'rlnAngleRot', 'rlnAngleRotPrior', 'rlnAngleTilt', 'rlnAnglePsi', 'rlnAnglePsiPrior', 'rlnOriginXAngst',
+          'rlnOriginYAngst', 'rlnAnglePsiFlipRatio', 'rlnOpticsGroup']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--in_parts', required=False, nargs='+', default=[], help='Starfiles to check on as well as the synthetic dataset (e.g. Class3D/job010/run_it001_data.star).')
+parser.add_argument('--stages', required=False, nargs='+', choices=STAGES, default=STAGES, help='Votes to check. Default all.')
+parser.add_argument('--modes', required=False, nargs='+', choices=MODES, default=MODES, help='Microtubules modes to check against the reference. Default all.')
+parser.add_argument('--micrographs', required=False, type=int, default=100, help='Number of micrographs in the synthetic dataset (0 for none). Default 100.')
+parser.add_argument('--seed', required=False, type=int, default=0, help='Random seed of the synthetic dataset. Default 0.')
+parser.add_argument('--conf', required=False, type=float, default=50, help='Protofilament number confidence cutoff. Default 50.')
+parser.add_argument('--seam_conf', required=False, type=float, default=40, help='Seam confidence cutoff. Default 40.')
+parser.add_argument('--pf', required=False, type=int, default=14, help='Protofilament number for the seam vote. Default 14.')
+parser.add_argument('--rise', required=False, type=float, default=9.3, help='Subunit rise (Angstrom) for the seam vote. Default 9.3.')
+parser.add_argument('--xy_cutoff', required=False, type=float, default=4, help='X/Y shift cutoff. Default 4.')
+parser.add_argument('--pipeline', required=False, type=int, default=16, help='Chunk size (microtubules) for the pipelined mode. Default 16.')
+parser.add_argument('--max_memory', required=False, type=float, default=0.05, help='Memory limit (MB) of the external sort in the streamed mode. Default 0.05, so that sorting uses several temporary files.')
+parser.add_argument('--tolerance', required=False, type=float, default=1e-9, help='Relative and absolute tolerance for numbers. Default 1e-9.')
+parser.add_argument('--compact_tolerance', required=False, type=float, default=1e-4, help='Tolerance for the compact mode, which stores angles and shifts in single precision. Default 1e-4.')
+parser.add_argument('--max_report', required=False, type=int, default=10, help='Number of differences to list for each check. Default 10.')
+parser.add_argument('--fail_slower', required=False, action='store_true', help='Exit with a non-zero status if any vote or function is slower than the reference, as well as for differences.')
+parser.add_argument('--keep', required=False, action='store_true', help='Keep the working folder of input and output starfiles.')
+args = parser.parse_args()
+
+
+###### Synthetic data ######
+#write a synthetic dataset of microtubules with nclasses classes, in shuffled order. Microtubules include ones too short to
+#vote on, class switches part way along (so that they are split), alternating classes (ties), Rot angles with a supertwist
+#slope and outliers, Psi flips (after the first two particles, so that Psi can always be clustered), and X/Y shifts with jumps
+def write_synthetic(name, n_micrographs, nclasses, seed):
+    rng = random.Random(seed)
+    rows = []
+    for m in range(1, n_micrographs+1):
+        mgph = 'MotionCorr/job002/Micrographs/mic%05i.mrc' % m
+        n = 0
+        for tube in range(1, rng.randint(2, 6)):
+            length = rng.choice([rng.randint(1, 8), rng.randint(8, 40)])
+            cls, other = rng.randint(1, nclasses), rng.randint(1, nclasses)
+            switch = rng.randint(1, length) if rng.random() < 0.3 else length
+            tie = rng.random() < 0.1
+            rot0, psi0 = rng.uniform(-180, 180), rng.uniform(-180, 180)
+            x0, y0 = rng.gauss(0, 3), rng.gauss(0, 3)
+            for k in range(length):
+                n += 1
+                c = (cls, other)[k % 2] if tie else cls if k < switch else other
+                if rng.random() < 0.15:
+                    c = rng.randint(1, nclasses)
+                rot = rot0 + 0.5 * k + (rng.uniform(-180, 180) if rng.random() < 0.2 else rng.gauss(0, 2))
+                psi = psi0 + (180 if k > 1 and rng.random() < 0.1 else 0) + rng.gauss(0, 1)
+                xsh = x0 + 0.1 * k + (rng.uniform(-20, 20) if rng.random() < 0.1 else rng.gauss(0, 1))
+                ysh = y0 - 0.1 * k + (rng.uniform(-20, 20) if rng.random() < 0.1 else rng.gauss(0, 1))
+                rot, psi = (rot + 180) % 360 - 180, (psi + 180) % 360 - 180
+                rows.append(['%06i@Extract/job003/Micrographs/mic%05i.mrcs' % (n, m), mgph, tube, k * 82.0, c, round(rot, 6),
+                             round(rot, 6), 90.0, round(psi, 6), round(psi0, 6), round(xsh, 6), round(ysh, 6), 0.5, 1])
+    rng.shuffle(rows)
+    star = starfileIO.Starfile(name)
+    star.add_datablock('data_optics', OrderedDict([('rlnOpticsGroupName', ['opticsGroup1']), ('rlnOpticsGroup', [1]),
+                                                   ('rlnImagePixelSize', [1.5]), ('rlnImageSize', [64])]))
+    star.add_datablock('data_particles', OrderedDict(zip(LABELS, [list(col) for col in zip(*rows)])))
+    star.write_star(name)
+    return name
+
+
+###### Running votes ######
+#run one vote with the reference, writing the kept microtubules to outfile, and the same summary plots as Microtubules (as the
+#original voting did), so that both are timed doing the same work. Returns the confidence values (None for X/Y)
+def run_reference(stage, starfile, outfile):
+    star, mts = reference.read_microtubules(starfile)
+    confidence = None
+    if stage == 'pf':
+        mts, confidence = reference.vote_pf_number(mts, args.conf)
+        cutoff = args.conf
+    elif stage == 'rot':
+        mts, confidence = reference.vote_on_rot(mts)
+        cutoff = 0
+    elif stage == 'xy':
+        mts = reference.vote_on_xy(mts, args.xy_cutoff)
+    elif stage == 'seam':
+        mts, confidence = reference.vote_on_seam(mts, args.seam_conf, args.pf, args.rise)
+        cutoff = args.seam_conf
+        distribution = collections.Counter(reference.microtubules_to_particles(mts)['rlnClassNumber'] if mts else [])
+        microtubules.plot_seam_stats(microtubules.seam_stats(distribution), outfile.replace('.star', '_seam.pdf'))
+    if confidence is not None:
+        microtubules.plot_confidence(confidence, cutoff, outfile.replace('.star', '_confidence.pdf'))
+    reference.write_microtubules(star, mts, outfile)
+    return confidence
+
+#run one vote with Microtubules in the given mode, writing to job_path. Returns the output starfiles and the confidence values
+def run_engine(stage, starfile, job_path, mode):
+    options = {'pipeline': {'pipeline': args.pipeline}, 'streamed': {'max_memory': args.max_memory * 1024**2},
+               'compact': {'compact': True}}.get(mode, {})
+    mts = microtubules.Microtubules(starfile, job_path, **options)
+    mts.set_plot_options(None)
+    mts.show_progress = False
+    if stage == 'pf':
+        mts.vote_pf_number(args.conf)
+        outfiles = sorted(glob.glob('%s1*pf_data.star' % job_path))
+    elif stage == 'rot':
+        mts.vote_on_rot()
+        outfiles = [mts.outfile]
+    elif stage == 'xy':
+        mts.vote_on_xy(args.xy_cutoff)
+        outfiles = [mts.outfile]
+    elif stage == 'seam':
+        mts.vote_on_seam(args.seam_conf, args.pf, args.rise)
+        outfiles = [mts.outfile]
+    confidence = mts.confidence.get_entry('data_confidence', 'mirpConfidence') if stage != 'xy' else None
+    return outfiles, confidence
+
+#time a function call, returning the time taken (seconds) and its result
+def timed(fn, *fn_args):
+    start = time.perf_counter()
+    result = fn(*fn_args)
+    return time.perf_counter() - start, result
+
+
+###### Comparison ######
+def tube_key(mt):
+    return (mt['rlnMicrographName'][0], int(mt['rlnHelicalTubeID'][0]))
+
+#whether two values (numbers within the tolerance, or otherwise equal) are the same
+def same(a, b, tolerance):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=tolerance, abs_tol=tolerance)
+    return a == b
+
+#compare the microtubules of the reference and engine, returning a list of differences as (microtubule, description)
+def compare_microtubules(ref_mts, engine_mts, tolerance):
+    ref, engine = OrderedDict((tube_key(mt), mt) for mt in ref_mts), OrderedDict((tube_key(mt), mt) for mt in engine_mts)
+    differences = []
+    for key in sorted(set(ref) | set(engine)):
+        if key not in engine:
+            differences.append((key, 'removed, but kept by the reference'))
+        elif key not in ref:
+            differences.append((key, 'kept, but removed by the reference'))
+        elif list(ref[key]) != list(engine[key]):
+            differences.append((key, 'labels %s, reference labels %s' % (' '.join(engine[key]), ' '.join(ref[key]))))
+        elif reference.microtubule_len(ref[key]) != reference.microtubule_len(engine[key]):
+            differences.append((key, '%i particles, reference has %i' % (reference.microtubule_len(engine[key]), reference.microtubule_len(ref[key]))))
+        else:
+            for label in ref[key]:
+                for ix, (a, b) in enumerate(zip(ref[key][label], engine[key][label])):
+                    if not same(a, b, tolerance):
+                        differences.append((key, '%s of particle %i is %s, reference %s' % (label, ix+1, b, a)))
+                        break
+    return differences
+
+#compare two lists of values (e.g. confidence values, or the results of a function for each microtubule), returning a list
+#of differences as (index, description)
+def compare_values(ref_values, engine_values, tolerance):
+    if len(ref_values) != len(engine_values):
+        return [(None, '%i values, reference has %i' % (len(engine_values), len(ref_values)))]
+    differences = []
+    for ix, (a, b) in enumerate(zip(ref_values, engine_values)):
+        if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+            equal = len(a) == len(b) and all(same(x, y, tolerance) for x, y in zip(a, b))
+        else:
+            equal = same(a, b, tolerance)
+        if not equal:
+            differences.append((ix, '%s, reference %s' % (b, a)))
+    return differences
+
+#print the differences of one check, and return whether there were none
+def report(differences):
+    for where, description in differences[:args.max_report]:
+        if isinstance(where, tuple):
+            where = '%s tube %i' % where
+        print('      %s: %s' % (where, description) if where is not None else '      %s' % description)
+    if len(differences) > args.max_report:
+        print('      ... and %i more' % (len(differences) - args.max_report))
+    return not differences
+
+#read the microtubules of one or more output starfiles
+def read_outputs(outfiles):
+    mts = []
+    for outfile in outfiles:
+        mts += reference.read_microtubules(outfile)[1]
+    return mts
+
+def speedup(ref_time, engine_time):
+    return '%8.1fx' % (ref_time / engine_time) if engine_time else '       -'
+
+#a warning to print after a check slower than the reference (counted in slower), or nothing
+def slower_warning(ref_time, engine_time):
+    if engine_time <= ref_time:
+        return ''
+    slower.append(ref_time / engine_time)
+    return '  WARNING: slower than the reference'
+
+
+###### Checks ######
+#check each vote of each mode on one dataset (a starfile for each stage). Returns whether there were no differences
+def check_votes(name, starfiles):
+    passed = True
+    print('  %-6s %-9s %12s %10s %9s  %s' % ('vote', 'mode', 'reference', 'engine', 'speedup', 'differences'))
+    for stage in args.stages:
+        ref_out = '%s/%s_%s_reference.star' % (name, name, stage)
+        ref_time, ref_confidence = timed(run_reference, stage, starfiles[stage], ref_out)
+        ref_mts = read_outputs([ref_out])
+        for mode in args.modes:
+            job_path = '%s/%s_%s/' % (name, stage, mode)
+            os.makedirs(job_path)
+            engine_time, (outfiles, confidence) = timed(run_engine, stage, starfiles[stage], job_path, mode)
+            tolerance = args.compact_tolerance if mode == 'compact' else args.tolerance
+            differences = compare_microtubules(ref_mts, read_outputs(outfiles), tolerance)
+            if ref_confidence is not None:
+                differences += [('confidence %s' % (ix+1 if ix is not None else ''), d)
+                                for ix, d in compare_values(ref_confidence, confidence, tolerance)]
+            print('  %-6s %-9s %10.3f s %8.3f s %s  %i' % (stage, mode, ref_time, engine_time, speedup(ref_time, engine_time), len(differences))
+                  + slower_warning(ref_time, engine_time))
+            passed &= report(differences)
+    return passed
+
+#check the functions the votes are built on, for every microtubule of a dataset. Returns whether there were no differences
+def check_functions(name, starfile):
+    _, mts = reference.read_microtubules(starfile)
+    job_path = '%s/functions/' % name
+    os.makedirs(job_path)
+    engine = microtubules.Microtubules(starfile, job_path)
+    classes = [mt['rlnClassNumber'] for mt in mts]
+    offsets = engine.get_offsets()
+
+    #window mode smoothing of class numbers, done for all microtubules at once by the engine
+    def engine_smoothen():
+        smoothened = helper_fns.segmented_window_mode(helper_fns.concat(classes), offsets, 3, 4).tolist()
+        return [smoothened[lo:hi] for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+    #seam mapping of every class for protofilament numbers 9 to 16
+    seam_classes = [(cls, pfnum) for pfnum in range(9, 17) for cls in range(1, pfnum+1)]
+    checks = [('mode smoothing', lambda: [reference.mode_smoothen(c) for c in classes], engine_smoothen),
+              ('Rot clusters', lambda: [reference.cluster_shallow_slopes(mt['rlnAngleRot'], 8)[0] or [] for mt in mts],
+                               lambda: [engine._cluster_shallow_slopes(mt['rlnAngleRot'], 8)[0] or [] for mt in engine]),
+              ('X/Y breaks', lambda: [max(reference.cluster_breaks(mt['rlnOriginXAngst'], args.xy_cutoff), key=len) for mt in mts],
+                             lambda: [max(engine._cluster_breaks(mt['rlnOriginXAngst'], args.xy_cutoff), key=len) for mt in engine]),
+              ('seam mapping', lambda: [reference.convert_pfnum_to_semicircle(*c) for c in seam_classes],
+                               lambda: [microtubules.convert_pfnum_to_semicircle(*c) for c in seam_classes])]
+    passed = True
+    print('  %-16s %10s %10s %9s  %s' % ('function', 'reference', 'engine', 'speedup', 'differences'))
+    for check, ref_fn, engine_fn in checks:
+        ref_time, ref_values = timed(ref_fn)
+        engine_time, engine_values = timed(engine_fn)
+        differences = compare_values(ref_values, engine_values, args.tolerance)
+        keys = seam_classes if check == 'seam mapping' else [tube_key(mt) for mt in mts]
+        differences = [(keys[ix] if ix is not None else None, d) for ix, d in differences]
+        if check == 'seam mapping':
+            differences = [('class %i of %iPF' % where, d) for where, d in differences]
+        print('  %-16s %8.3f s %8.3f s %s  %i' % (check, ref_time, engine_time, speedup(ref_time, engine_time), len(differences))
+              + slower_warning(ref_time, engine_time))
+        passed &= report(differences)
+    return passed
+
+#check protofilament number votes on microtubules loaded in each mode (except pipelined and streamed, which are not held in memory),
+#exported to Arrow or pandas (with their offsets), and made again with Microtubules.from_arrow. Returns whether there were no
+#differences
+def check_export(name, starfile):
+    ref_out = '%s/%s_export_reference.star' % (name, name)
+    run_reference('pf', starfile, ref_out)
+    ref_mts = read_outputs([ref_out])
+    formats = [fmt for fmt, lib in (('arrow', 'pyarrow'), ('pandas', 'pandas')) if importlib.util.find_spec(lib)]
+    if not formats:
+        print('  export not checked (pyarrow and pandas are not installed)')
+        return True
+    passed = True
+    print('  %-6s %-16s %s' % ('export', 'mode', 'differences'))
+    for mode in [mode for mode in args.modes if mode not in ('pipeline', 'streamed')]:
+        for fmt in formats:
+            job_path = '%s/export_%s_%s/' % (name, mode, fmt)
+            os.makedirs(job_path)
+            mts = microtubules.Microtubules(starfile, job_path, compact=mode == 'compact')
+            table = mts.to_arrow() if fmt == 'arrow' else mts.to_pandas()
+            differences = []
+            if starfileIO.arrow_metadata(table)['offsets'] != mts.get_offsets().tolist():
+                differences.append((None, 'exported microtubule offsets differ from get_offsets'))
+            mts = microtubules.Microtubules.from_arrow(table, job_path)
+            mts.set_plot_options(None)
+            mts.show_progress = False
+            mts.vote_pf_number(args.conf)
+            tolerance = args.compact_tolerance if mode == 'compact' else args.tolerance
+            differences += compare_microtubules(ref_mts, read_outputs(sorted(glob.glob('%s1*pf_data.star' % job_path))), tolerance)
+            print('  %-6s %-16s %i' % (fmt, mode, len(differences)))
+            passed &= report(differences)
+    return passed
+
+
+#import the libraries used by both before timing, so that neither is timed importing them
+for lib in (microtubules.np, microtubules.stats, microtubules.plt):
+    lib._load()
+
+workdir = tempfile.mkdtemp(prefix='mirp_check_')
+datasets = []
+for i, starfile in enumerate(args.in_parts):
+    datasets.append(('input%i' % (i+1), {stage: os.path.abspath(starfile) for stage in STAGES}))
+cwd = os.getcwd()
+os.chdir(workdir)
+#Microtubules is run in a RELION project folder
+open('default_pipeline.star', 'w').close()
+if args.micrographs:
+    #the seam vote uses classes for each seam position in and out of register, the other votes protofilament number classes
+    synthetic = write_synthetic('synthetic.star', args.micrographs, 6, args.seed)
+    synthetic_seam = write_synthetic('synthetic_seam.star', args.micrographs, 2 * args.pf, args.seed)
+    datasets.insert(0, ('synthetic', dict({stage: synthetic for stage in STAGES}, seam=synthetic_seam)))
+
+passed = True
+slower = []
+try:
+    for name, starfiles in datasets:
+        os.makedirs(name)
+        _, mts = reference.read_microtubules(starfiles['pf'])
+        print('\n%s (%s): %i microtubules, %i particles' % (name, starfiles['pf'], len(mts), sum(map(reference.microtubule_len, mts))))
+        passed &= check_votes(name, starfiles)
+        passed &= check_functions(name, starfiles['pf'])
+        passed &= check_export(name, starfiles['pf'])
+finally:
+    os.chdir(cwd)
+    if args.keep:
+        print('\nWorking folder kept in %s' % workdir)
+    else:
+        shutil.rmtree(workdir)
+
+print('\nNo differences found.' if passed else '\nDifferences found!')
+if slower:
+    print('WARNING: %i checks were slower than the reference (down to %.2fx).' % (len(slower), min(slower)))
+if not passed or (slower and args.fail_slower):
+    sys.exit(1)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+external_sort.py provides an external merge sort of the particles in a starfile by micrograph, microtubule and track length,
+for starfiles too large to sort in memory. Sorted runs of particles are spilled to temporary binary files, and merged into
+a stream of microtubules, so that particles can be sorted and grouped in bounded memory.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+import starfileIO
+import helper_fns
+import itertools
+import tempfile
+import pickle
+import heapq
+import sys
+import os
+
+#labels that particles are sorted by, as in Microtubules
+SORT_LABELS = ('rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
+#number of particles pickled together in each spilled run, and read back at a time while merging
+CHUNK = 1024
+#maximum number of spilled runs open at once. Beyond this, the runs so far are merged into one
+MAX_RUNS = 256
+
+
+#read the labels and data of every datablock of a starfile, except the rows of one loop datablock. Returns a Starfile holding
+#the labels of that datablock with no data, for use with iter_rows. The fields of each line (as from helper_fns.readfile) can
+#be given as lines, instead of reading the whole starfile
+def read_header(starfile, datablock_id='data_particles', lines=None):
+    star = starfileIO.Starfile(starfile)
+    loop = False
+    curr = None
+    for fields in (helper_fns.readfile(starfile) if lines is None else lines):
+        if fields[0].startswith('data_'):
+            curr = OrderedDict()
+            star.add_datablock(fields[0], curr)
+            block = fields[0]
+            loop = False
+        elif fields[0] == 'loop_':
+            loop = True
+        elif fields[0].startswith('_'):
+            curr[fields[0][1:]] = [] if loop else helper_fns.literal_eval(fields[1])
+        elif loop and block != datablock_id:
+            for label, data in zip(curr.keys(), fields):
+                curr[label].append(helper_fns.literal_eval(data))
+    return star
+
+#yield the rows (lists of unparsed fields) of one loop datablock of a starfile, in file order
+def iter_rows(starfile, datablock_id='data_particles'):
+    inblock = False
+    for fields in helper_fns.readfile(starfile):
+        if fields[0].startswith('data_'):
+            inblock = fields[0] == datablock_id
+        elif inblock and fields[0] != 'loop_' and not fields[0].startswith('_'):
+            yield fields
+
+#write a sorted run of (key, row) pairs to a temporary file in chunks, and read them back as a stream
+def _spill(run, folder):
+    f = tempfile.TemporaryFile(dir=folder)
+    run = iter(run)
+    while True:
+        chunk = list(itertools.islice(run, CHUNK))
+        if not chunk:
+            break
+        pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    with f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+
+#merge sorted runs. Earlier runs come first in heapq.merge when keys are equal, so the merge keeps the order of the file
+def _merge(runs):
+    return heapq.merge(*[_read_run(f) for f in runs], key=lambda item: item[0])
+
+#whether the rows of one loop datablock are already sorted by the values in columns index. Only the sort keys are parsed, and
+#the scan stops at the first row out of order
+def rows_sorted(starfile, index, datablock_id='data_particles'):
+    prev = None
+    for fields in iter_rows(starfile, datablock_id):
+        key = tuple(helper_fns.literal_eval(fields[i]) for i in index)
+        if prev is not None and key < prev:
+            return False
+        prev = key
+    return True
+
+#yield the rows of one loop datablock sorted by the values in columns index, holding at most about max_memory bytes of rows at
+#once. Rows that are already sorted are streamed from the starfile without being held. Otherwise rows are sorted in runs that
+#fit in memory, which are spilled to temporary files in tmpdir, then merged. The sort is stable, as in memory
+def sorted_rows(starfile, index, max_memory, datablock_id='data_particles', tmpdir=None):
+    if rows_sorted(starfile, index, datablock_id):
+        for fields in iter_rows(starfile, datablock_id):
+            yield fields
+        return
+    folder = tempfile.mkdtemp(dir=tmpdir, prefix='mirp_sort_')
+    runs = []
+    run = []
+    run_bytes = 0
+    try:
+        for fields in iter_rows(starfile, datablock_id):
+            key = tuple(helper_fns.literal_eval(fields[i]) for i in index)
+            run.append((key, fields))
+            run_bytes += sys.getsizeof(fields) + sum(sys.getsizeof(val) for val in fields)
+            if run_bytes >= max_memory:
+                run.sort(key=lambda item: item[0])
+                runs.append(_spill(run, folder))
+                run = []
+                run_bytes = 0
+                if len(runs) >= MAX_RUNS:
+                    runs = [_spill(_merge(runs), folder)]
+        run.sort(key=lambda item: item[0])
+        if not runs:
+            for item in run:
+                yield item[1]
+            return
+        runs.append(_spill(run, folder))
+        run = []
+        for key, fields in _merge(runs):
+            yield fields
+    finally:
+        for f in runs:
+            f.close()
+        os.rmdir(folder)
+
+#sort the particles of a starfile in bounded memory, and group them into microtubules. Returns a Starfile of the other
+#datablocks (star, if already read with read_header), and a generator of microtubules (dictionaries of lists, as in Microtubules)
+#in sorted order
+def stream_microtubules(starfile, max_memory, tmpdir=None, star=None):
+    star = star or read_header(starfile)
+    labels = list(star.get_labels('data_particles'))
+    index = [labels.index(label) for label in SORT_LABELS]
+
+    def microtubules():
+        rows = sorted_rows(starfile, index, max_memory, tmpdir=tmpdir)
+        for _, group in itertools.groupby(rows, key=lambda fields: tuple(helper_fns.literal_eval(fields[i]) for i in index[:2])):
+            microtubule = OrderedDict((label, []) for label in labels)
+            for fields in group:
+                for label, data in zip(labels, fields):
+                    microtubule[label].append(helper_fns.literal_eval(data))
+            yield microtubule
+
+    return star, microtubules()
+
+#write a starfile in parts: write_head writes the datablocks of star up to and including the labels of one loop datablock,
+#write_rows then writes its rows (lists of values) as they become available, and write_tail writes the remaining datablocks
+def write_head(f, star, datablock_id='data_particles'):
+    keys = list(star._datablocks)
+    for key in keys[:keys.index(datablock_id)+1]:
+        star.write_datablock(f, key)
+
+def write_rows(f, rows):
+    for entry in rows:
+        f.write('\t'.join(str(val) for val in entry) + '\n')
+
+def write_tail(f, star, datablock_id='data_particles'):
+    keys = list(star._datablocks)
+    for key in keys[keys.index(datablock_id)+1:]:
+        star.write_datablock(f, key)
@@ -1,10 +1,9 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 """
-MiRP - a microtubule RELION-based pipeline for cryo-EM image processing. 
-This script is dependent on EMAN2 (tested with v2.13) and generates seam
-references for 3D seam classification from a single 3D reference
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+This script generates seam references for 3D seam classification from a single 3D reference
 """
 
 __author__ = 'Alexander D. Cook & Joseph Atherton'
@@ -12,9 +11,10 @@ __license__ = 'GPLv3'
 __version__ = '2.0'
 
 
-import EMAN2
 import argparse
-import microtubules
+import helper_fns
+import seam_references
+import reference_cache
 import starfileIO
 import os
 
@@ -26,47 +26,56 @@ parser.add_argument('-pf', help='protofilament number', type=int)
 parser.add_argument('-r', help='helical rise (angstrom)', type=float)
 parser.add_argument('-p', help='pixel size', type=float)
 parser.add_argument('-o', help='output location. Will make folder if does not currently exist')
+parser.add_argument('-j', help='number of seam positions to generate in parallel. Default is the number of CPUs', type=int, default=os.cpu_count())
+parser.add_argument('-s', help='shift along the helical axis (angstrom) of the second set of references, for testing alpha/beta-tubulin register. Default 40', type=float, default=40)
+parser.add_argument('--cache_dir', help='folder for caching generated reference sets. Default $MIRP_CACHE/seam_references or ~/.cache/mirp/seam_references', default=reference_cache.default_cache_dir())
+parser.add_argument('--cache_max_gb', help='maximum total size of cached reference sets (GB). Least recently used sets are removed first. Default 10', type=float, default=10)
+parser.add_argument('--no_cache', help='always generate new references, without using or adding to the cache', action='store_true')
 args = parser.parse_args()
 
 assert not os.path.exists(args.o), 'Error, output path already exists!'
 os.mkdir(args.o)
 
-pftotal = args.pf
-twist = -360.0 / float(pftotal)
-rise = args.r
-apix = args.p
+#create a starfile for input into RELION
+def write_star(name, outfiles, shifted_outfiles):
+    starout = starfileIO.Starfile(name)
+    starout.add_datablock('data_references', {'rlnReferenceImage': list(outfiles)})
+    starout.add_loop_data('data_references', {'rlnReferenceImage': shifted_outfiles})
+    starout.write_star(name)
 
-outfiles = []
-shifted_outfiles = []
+#reference sets are cached by the contents of the input volume and the parameters used to generate them
+key = None
+entry = None
+if not args.no_cache:
+    key = reference_cache.cache_key(args.i, args.pf, args.r, args.p, args.s)
+    entry = reference_cache.lookup(args.cache_dir, key)
 
-print('Generating seam references...')
-#for each possible relative seam position, create a new 3D volume 
-for pf in range(1, pftotal+1):
-    #read in 3D volume
-    ref = EMAN2.EMData()
-    ref.read_image(args.i)
-    #get +/- symmetry operators
-    seampos = microtubules.convert_pfnum_to_semicircle(pf, pftotal)
-    #calculate change in angle required for that seam position
-    Drot = seampos * twist
-    #calculate change in z-axis translation for that seam position
-    Dz = seampos * -rise / apix
-    #use EMAN2 to transform the original 3D volume and save
-    t = EMAN2.Transform({'type':'eman', 'az':Drot, 'tz':Dz})
-    ref.transform(t)
-    outfile = '%s/seamref%i.mrc' % (args.o, seampos)
-    ref.write_image(outfile)
-    outfiles.append(outfile)
-    # transform and save 40 angstrom shifted volume for testing alpha/beta-tubulin register
-    t=EMAN2.Transform({'type':'eman', 'tz':40/apix})
-    ref.transform(t)
-    outfile = '%s/seamref%i_40shift.mrc' % (args.o, seampos)    
-    ref.write_image(outfile)
-    shifted_outfiles.append(outfile)
+if entry:
+    print('Using cached seam references from %s...' % entry)
+    cached = starfileIO.Starfile('%s/%s' % (entry, reference_cache.COMPLETE))
+    cached.read_star()
+    outfiles = []
+    for name in cached.get_entry('data_references', 'rlnReferenceImage'):
+        outfile = '%s/%s' % (args.o, name)
+        reference_cache.copy_file('%s/%s' % (entry, name), outfile)
+        outfiles.append(outfile)
+    half = len(outfiles) // 2
+    write_star('%s/seam_references.star' % args.o, outfiles[:half], outfiles[half:])
+else:
+    outfiles = []
+    shifted_outfiles = []
+    print('Generating seam references...')
+    #for each possible relative seam position, create a new 3D volume, and a shifted volume for testing alpha/beta-tubulin register
+    jobs = [(args.i, args.o, pf, args.pf, args.r, args.p, args.s) for pf in range(1, args.pf+1)]
+    for outfile, shifted_outfile in helper_fns.bounded_imap(seam_references.seam_reference, jobs, min(args.j, args.pf)):
+        outfiles.append(outfile)
+        shifted_outfiles.append(shifted_outfile)
+    write_star('%s/seam_references.star' % args.o, outfiles, shifted_outfiles)
 
-#create a starfile for input into RELION
-starout = starfileIO.Starfile('%s/seam_references.star' % args.o)
-starout.add_datablock('data_references', {'rlnReferenceImage': outfiles})
-starout.add_loop_data('data_references', {'rlnReferenceImage': shifted_outfiles})
-starout.write_star('%s/seam_references.star' % args.o)
-print('Done!')
\ No newline at end of file
+    #the cached star file lists volumes relative to the cache entry
+    if key:
+        names = [os.path.basename(f) for f in outfiles], [os.path.basename(f) for f in shifted_outfiles]
+        entry = reference_cache.store(args.cache_dir, key, outfiles + shifted_outfiles, lambda name: write_star(name, *names))
+if entry:
+    reference_cache.evict(args.cache_dir, args.cache_max_gb * 1024**3, keep=entry)
+print('Done!')
@@ -1,10 +1,11 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 """
-MiRP - a microtubule RELION-based pipeline for cryo-EM image processing. 
-This script is dependent on EMAN2 (tested with v2.13) and generates microtubule 
-particles averaged over a 7-particle window
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+This script generates microtubule particles averaged over a sliding window of neighbouring particles (7 by default).
+Several window sizes can be given, in which case each particle stack is read and aligned once, and the segment averages
+of each window size are written to their own folder (window<size>) in the output folder
 """
 
 __author__ = 'Alexander D. Cook & Joseph Atherton'
@@ -12,100 +13,112 @@ __license__ = 'GPLv3'
 __version__ = '2.0'
 
 
-import starfileIO
 import microtubules
+import external_sort
 import helper_fns
+import segment_averages
+import arguments
 import argparse
 import sys
-import EMAN2 
 import re
 import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--in_parts', required=True, help='Input starfile (e.g. Class3D/PF_sorting/run_it001_data.star')
 parser.add_argument('-o', '--o', required=True, help='Output folder for segment averages (e.g. Extract/seg_averages)')
+parser.add_argument('-w', '--window', required=False, type=int, nargs='+', default=[7], help='Number of neighbouring particles to average over. Several sizes can be given (e.g. -w 3 5 7 9), each written to a window<size> folder in the output folder. Default 7.')
+parser.add_argument('--float32', required=False, action='store_true', help='Align particles in single rather than double precision, halving memory use.')
+parser.add_argument('-j', '--j', required=False, type=int, default=1, help='Number of micrographs to process in parallel. Default 1.')
+arguments.add_max_memory_argument(parser, 'average them one microtubule at a time')
+parser.add_argument('--max_in_flight', required=False, type=int, help='Maximum number of micrographs queued for processing at once, to limit memory use. Default is twice -j.')
 args = parser.parse_args()
 
+assert len(set(args.window)) == len(args.window), 'Error, the same window size is given more than once!'
+#output folder of each window size. A single window size is written to the output folder itself
+if len(args.window) == 1:
+    outdirs = [args.o]
+else:
+    outdirs = ['%s/window%i' % (args.o, window) for window in args.window]
+
 #can only make a new directory for segment averages (to avoid overwriting something else)
 assert not os.path.exists(args.o), 'Error, output path already exists!'
-os.makedirs('%s/Micrographs' % args.o)
+for outdir in outdirs:
+    os.makedirs('%s/Micrographs' % outdir)
 
 print('Reading in starfile...')
-mts = microtubules.Microtubules(args.in_parts, '.')
+outstars = ['%s/segment_averages.star' % outdir for outdir in outdirs]
+if args.max_memory:
+    #sort and group particles in bounded memory, and stream microtubules to averaging
+    star, mts = external_sort.stream_microtubules(args.in_parts, arguments.max_memory(args))
+    apix = float(star.get_entry('data_optics', 'rlnImagePixelSize')[0])
+else:
+    mts = microtubules.Microtubules(args.in_parts, '.')
+    apix = mts.apix
 name_regex = re.compile('.+/(.+\.mrcs)')
 
-for ix, microtubule in enumerate(mts):
-    sys.stdout.write('\rGenerating segment averages for microtubule %i for %i' % (ix, mts.mt_tot))
-    sys.stdout.flush()
-    #read particles from RELION stack into EMAN2
-    particle_stack = microtubule['rlnImageName'][0][7:]
-    spart = int(microtubule['rlnImageName'][0][:6])
-    epart = int(microtubule['rlnImageName'][-1][:6])
-    part_range = [i for i in range(spart-1, epart)]
-    images = EMAN2.EMData.read_images(particle_stack, part_range)
-    microtubule['images'] = images
-    mt_len = len(microtubule['rlnImageName'])
-    #prepare output 
-    mname = re.search(name_regex, microtubule['rlnImageName'][0]).group(1)
-    mname = mname.replace('.mrcs', '_SAs.mrcs')
-    outfile = args.o + '/Micrographs/' + mname 
-
-    #2D transform partices prior to averaging
-    for ptcl_index in range(mt_len):
-        try:
-            psi = microtubule['rlnAnglePsi'][ptcl_index]
-        except KeyError:
-            psi = microtubule['rlnAnglePsiPrior'][ptcl_index]
-        try:
-            xsh = microtubule['rlnOriginXAngst'][ptcl_index] / mts.apix
-            ysh = microtubule['rlnOriginYAngst'][ptcl_index] / mts.apix
-        except KeyError:
-            xsh, ysh = 0, 0
-        t = EMAN2.Transform()
-        t.set_params({'type':'2d', 'alpha':psi, 'tx':xsh, 'ty':ysh})
-        microtubule['images'][ptcl_index].transform(t)
+#collect the microtubules of each micrograph into one job, which writes one segment average stack per window size
+def micrograph_jobs(mts):
+    written = set()
+    outfile = None
+    tubes = []
+    for microtubule in mts:
+        particle_stack = microtubule['rlnImageName'][0][7:]
+        spart = int(microtubule['rlnImageName'][0][:6])
+        epart = int(microtubule['rlnImageName'][-1][:6])
+        psi, xsh, ysh = segment_averages.get_alignment(microtubule, apix)
+        mname = re.search(name_regex, microtubule['rlnImageName'][0]).group(1)
+        mname = mname.replace('.mrcs', '_SAs.mrcs')
+        mt_outfile = outdirs[0] + '/Micrographs/' + mname 
+        if outfile is not None and mt_outfile != outfile:
+            yield (outfiles, apix, args.window, args.float32, tubes)
+            tubes = []
+        assert mt_outfile not in written or mt_outfile == outfile, 'Error, particles from stack %s belong to more than one micrograph.' % particle_stack
+        written.add(mt_outfile)
+        outfile = mt_outfile
+        outfiles = [outdir + '/Micrographs/' + mname for outdir in outdirs]
+        tubes.append((particle_stack, spart-1, epart, psi, xsh, ysh))
+    if tubes:
+        yield (outfiles, apix, args.window, args.float32, tubes)
 
-    #average along a sliding window
-    for ptcl_index in range(mt_len):
-        low, hi = helper_fns.get_window(ptcl_index, 3, 4, mt_len)
-        avg = EMAN2.Averagers.get('mean')
-        for i in range(low, hi):
-            avg.add_image(microtubule['images'][i])
-        avg_img = avg.finish()
-        #transform segment average back to original position and save
-        try:
-            psi = microtubule['rlnAnglePsi'][ptcl_index]
-        except KeyError:
-            psi = microtubule['rlnAnglePsiPrior'][ptcl_index]
-        try:
-            xsh = microtubule['rlnOriginXAngst'][ptcl_index] / mts.apix
-            ysh = microtubule['rlnOriginYAngst'][ptcl_index] / mts.apix
-        except KeyError:
-            xsh, ysh = 0, 0
-        t = EMAN2.Transform()
-        t.set_params({'type':'2d', 'alpha':-psi, 'tx':-xsh, 'ty':-ysh})
-        avg_img.transform(t)
-        avg_img.append_image(outfile)
+#for streamed microtubules, write the segment average starfile rows of each microtubule (to the starfile of each window size)
+#as it is queued for averaging
+def write_as_queued(mts, files):
+    mgph = None
+    for microtubule in mts:
+        if microtubule['rlnMicrographName'][0] != mgph:
+            mgph = microtubule['rlnMicrographName'][0]
+            number = 1
+        for f, outdir in zip(files, outdirs):
+            names = segment_averages.tube_segment_average_names(microtubule['rlnImageName'], number, outdir)
+            external_sort.write_rows(f, zip(*[names if label == 'rlnImageName' else data for label, data in microtubule.items()]))
+        number += len(names)
+        yield microtubule
 
-#update per micrograph information in starfile
-starfile_data = starfileIO.Starfile(args.in_parts)
-starfile_data.read_star()    
-starfile_data.sort_loop_datablock('data_particles', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
-particles = starfile_data.get_datablock('data_particles')
-micrographs = helper_fns.group_dict_of_list(particles, 'rlnMicrographName')
-image_names = []
-def format_particle_number(s1, s2):
-    return (s1[:-len(s2)] + s2)
+#each micrograph is independent, so micrographs are averaged in parallel, each worker writing its own output stack
+if args.max_memory:
+    files = [open(outstar, 'w') for outstar in outstars]
+    for f in files:
+        external_sort.write_head(f, star)
+    results = helper_fns.bounded_imap(segment_averages.average_micrograph, micrograph_jobs(write_as_queued(mts, files)), args.j, args.max_in_flight)
+    for ix, _ in enumerate(results):
+        sys.stdout.write('\rGenerated segment averages for particle stack %i' % (ix+1))
+        sys.stdout.flush()
+    for f in files:
+        external_sort.write_tail(f, star)
+        f.close()
+else:
+    #one job (and output stack) for each particle stack
+    njobs = len(set(name[7:] for name in mts.starfile_data.get_entry('data_particles', 'rlnImageName')))
+    results = helper_fns.bounded_imap(segment_averages.average_micrograph, micrograph_jobs(mts), args.j, args.max_in_flight)
+    for ix, _ in enumerate(results):
+        sys.stdout.write('\rGenerated segment averages for particle stack %i of %i' % (ix+1, njobs))
+        sys.stdout.flush()
 
-for mgph in micrographs:
-    for index, name in enumerate(mgph['rlnImageName']):
-        mgphname = re.search(name_regex, name).group(1)
-        mgphname = mgphname.replace('.mrcs', '_SAs.mrcs')
-        pnum = format_particle_number('000000', str(index+1))
-        image_name = pnum + '@' + args.o + '/Micrographs/' + mgphname
-        image_names.append(image_name)
-        
-particles['rlnImageName'] = image_names
-starfile_data.add_datablock('data_particles', particles)
-starfile_data.write_star('%s/segment_averages.star' % args.o)
-print('\nFinished! Wrote %s/segment_averages.star' % args.o)    
\ No newline at end of file
+    #update per micrograph information in the sorted starfile data already read in, for each window size. Names are made from
+    #the particle names read in, not those of the previous window size
+    particles = mts.starfile_data.get_datablock('data_particles')
+    image_names = particles['rlnImageName']
+    for outdir, outstar in zip(outdirs, outstars):
+        particles['rlnImageName'] = segment_averages.segment_average_names(mts, outdir, image_names)
+        mts.starfile_data.write_star(outstar)
+print('\nFinished! Wrote %s' % ', '.join(outstars))
@@ -14,8 +14,47 @@ __version__ = '2.0'
 from itertools import groupby
 from operator import itemgetter
 from collections import OrderedDict
+import importlib
 import ast
-import numpy as np
+import os
+import sys
+
+
+#defers importing a module until one of its attributes is first used, so that scripts which never plot or
+#do statistics do not pay the (often several second) import cost of NumPy, SciPy and matplotlib
+class LazyModule:
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            if self._setup is not None:
+                self._setup()
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return 'LazyModule(%s)' % self._name
+
+
+#choose a non-interactive matplotlib backend when there is no display to draw to (e.g. on cluster nodes).
+#must be called before pyplot is first imported. An explicit MPLBACKEND environment variable always wins.
+def select_mpl_backend(interactive=True):
+    if 'MPLBACKEND' in os.environ:
+        return
+    headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    if headless or not interactive:
+        import matplotlib
+        matplotlib.use('Agg')
+
+
+np = LazyModule('numpy')
 
 
 def get_window(index, lw, hi, size):
@@ -40,6 +79,113 @@ def group_dict_of_list(dict, *labels):
     return grouped
 
 
+#label runs of equal consecutive values (e.g. in sorted data) with integer codes 0, 1, 2...
+#returns the code of each value, and the index at which each run starts
+def run_codes(values):
+    values = np.asarray(values)
+    change = np.ones(len(values), dtype=bool)
+    change[1:] = values[1:] != values[:-1]
+    return np.cumsum(change) - 1, np.flatnonzero(change)
+
+
+#position of each value within its segment (starting from 1), for data split into consecutive segments at offsets
+#(the start index of each segment, followed by the total length)
+def segment_positions(offsets):
+    lengths = np.diff(offsets)
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths) + 1
+
+
+#most common value in each segment of integer data (e.g. class numbers), for data split into consecutive segments at offsets.
+#returns the mode and its number of occurrences. Ties go to the value that occurs first in the segment (as collections.Counter)
+def segmented_mode(values, offsets):
+    values = np.asarray(values, dtype=np.int64)
+    nsegments = len(offsets) - 1
+    if not len(values):
+        return np.zeros(nsegments, dtype=np.int64), np.zeros(nsegments, dtype=np.int64)
+    low = values.min()
+    nvalues = values.max() - low + 1
+    segment = np.repeat(np.arange(nsegments), np.diff(offsets))
+    key = segment * nvalues + values - low
+    counts = np.bincount(key, minlength=nsegments * nvalues).reshape(nsegments, nvalues)
+    #index of the first occurrence of each value in each segment
+    first = np.full(nsegments * nvalues, len(values))
+    unique, index = np.unique(key, return_index=True)
+    first[unique] = index
+    first = first.reshape(nsegments, nvalues)
+    best = counts.max(axis=1)
+    mode = np.where(counts == best[:, None], first, len(values)).argmin(axis=1)
+    return mode + low, best
+
+
+#most common value over a window of lw values before to hi values after each value (as get_window) of integer data, without
+#crossing the boundaries of segments at offsets. Ties go to the smallest value (as scipy.stats.mode)
+def segmented_window_mode(values, offsets, lw, hi):
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return values
+    low = values.min()
+    nvalues = values.max() - low + 1
+    #cumulative count of each value, so that the counts in any window are a difference of two rows
+    cumulative = np.zeros((len(values) + 1, nvalues), dtype=np.int32)
+    np.cumsum(np.eye(nvalues, dtype=np.int32)[values - low], axis=0, out=cumulative[1:])
+    lengths = np.diff(offsets)
+    index = np.arange(len(values))
+    lwin = np.maximum(index - lw, np.repeat(offsets[:-1], lengths))
+    hwin = np.minimum(index + hi, np.repeat(offsets[1:], lengths))
+    return (cumulative[hwin] - cumulative[lwin]).argmax(axis=1) + low
+
+
+#least-squares straight line fit of y against x for every segment at once, using segmented sums.
+#returns the slope, y-intercept and root mean square residual of each segment (nan for segments shorter than 2)
+def segmented_linregress(x, y, offsets):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    starts, n = offsets[:-1], np.diff(offsets).astype(np.float64)
+    sx, sy = np.add.reduceat(x, starts), np.add.reduceat(y, starts)
+    sxx, sxy = np.add.reduceat(x * x, starts), np.add.reduceat(x * y, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        yincept = (sy - slope * sx) / n
+        lengths = np.diff(offsets)
+        residual = y - (np.repeat(yincept, lengths) + np.repeat(slope, lengths) * x)
+        rms = np.sqrt(np.add.reduceat(residual * residual, starts) / n)
+    return slope, yincept, rms
+
+
+#values of a list or array at the given indices, keeping arrays (e.g. compact starfile columns) as arrays
+def take(values, index):
+    if getattr(values, 'ndim', 0) == 1:
+        return values[np.asarray(index, dtype=np.int64)]
+    return [values[i] for i in index]
+
+
+#join several lists or arrays of values into one list, or into one array if they are all arrays. Arrays that are consecutive
+#views covering the whole of one array (e.g. microtubules split from a sorted column) give back that array, without copying
+def concat(columns):
+    columns = list(columns)
+    if columns and all(getattr(c, 'ndim', 0) == 1 for c in columns):
+        base = shared_base(columns)
+        return base if base is not None else np.concatenate(columns)
+    data = []
+    for c in columns:
+        data += c
+    return data
+
+
+#the array that a list of arrays are consecutive views of, in order and covering all of it, or None
+def shared_base(columns):
+    base = columns[0].base
+    if getattr(base, 'ndim', 0) != 1 or not base.flags.c_contiguous or sum(len(c) for c in columns) != len(base):
+        return None
+    address = base.__array_interface__['data'][0]
+    for c in columns:
+        if c.base is not base or c.dtype != base.dtype or (len(c) > 1 and c.strides != base.strides) or \
+           (len(c) and c.__array_interface__['data'][0] != address):
+            return None
+        address += len(c) * base.itemsize
+    return base
+
+
 def sort_dict_of_list(dict, *keys):
     data = trnsp_dict_of_lst(dict)
     data = sorted(data, key=itemgetter(*keys))
@@ -93,4 +239,30 @@ def readfile(filepath):
             elif fields[0].startswith('#'):
                 pass
             else:
-                yield fields
\ No newline at end of file
+                yield fields
+
+#map fn over jobs in a pool of worker processes, yielding results in the order of jobs. At most max_in_flight jobs are
+#submitted at any one time, which bounds the memory held by queued jobs and unreturned results.
+#with one process, jobs are run in this process. Jobs can not be None
+def bounded_imap(fn, jobs, processes, max_in_flight=None):
+    if processes <= 1:
+        for job in jobs:
+            yield fn(job)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+    max_in_flight = max(processes, max_in_flight or 2 * processes)
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        in_flight = deque()
+        for job in jobs:
+            in_flight.append(pool.submit(fn, job))
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            result = in_flight.popleft().result()
+            #replace the finished job with the next one, if there are any left
+            job = next(jobs, None)
+            if job is not None:
+                in_flight.append(pool.submit(fn, job))
+            yield result
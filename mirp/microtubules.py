@@ -12,38 +12,88 @@ __version__ = '2.0'
 
 
 import starfileIO
+import external_sort
 import helper_fns
-from scipy import stats
-import numpy as np
+import plotting
+import pipeline
 import collections
 import itertools
 import operator
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 import math
 import os
 import warnings
 
+#plotting and statistics backends are only imported on first use
+np = helper_fns.np
+stats = helper_fns.LazyModule('scipy.stats')
+plt = helper_fns.LazyModule('matplotlib.pyplot', setup=helper_fns.select_mpl_backend)
+
+#LRU cache of parsed and grouped starfiles (see service.DatasetCache), set in long-lived processes such as the MiRP server,
+#so that a starfile parsed by one job is not parsed again by the next. None turns caching off
+dataset_cache = None
+#labels particles are sorted by, grouping them into microtubules in order along each microtubule
+SORT_KEYS = ('rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
+
 class Microtubules:
 
-    def __init__(self, starfile_in, job_path):
+    def __init__(self, starfile_in, job_path, max_memory=None, pipeline=None, compact=False):
         #check if in RELION directory, and setup output path and standard out
         assert os.path.exists('default_pipeline.star'), 'default_pipeline.star not found. Please execute in a RELION directory'
         self.job_path = job_path
         self.stdout = '%s/run.out' % self.job_path
         self.outfile = None
+        self.plot_options = None
+        #write the microtubule being corrected to run.out as a progress bar for the RELION GUI
+        self.show_progress = True
+        self.confidence = None
+        self._layout = None
+        self._columns = {}
+        self._tube_lookup = (None, {})
+        #sort particles with an external merge sort, holding at most about max_memory bytes of unsorted particles at once. The
+        #sorted particles are streamed to each vote a micrograph at a time (or in pipelined chunks), rather than held in memory
+        self.max_memory = max_memory
+        #vote on chunks of at least this many microtubules (whole micrographs) at a time, while the next chunk is read and
+        #decoded, and finished chunks are written, in background threads. Input that is not already sorted is sorted first (see
+        #_tube_chunks). Labels reset with reset_eulerxy are reset in each chunk
+        self.pipeline = pipeline
+        self._resets = []
+        #store angles, shifts, class numbers and tube IDs as compact arrays (see starfileIO.COMPACT_DTYPES). Streamed
+        #microtubules are only held a chunk at a time, so are not stored compactly
+        assert not (compact and (pipeline or max_memory)), 'compact can not be used with pipeline or max_memory, which stream microtubules instead of holding them in memory.'
+        self.compact = compact
         
-        #read in data_particles datablock from _data.star type file
-        self.starfile_in = starfile_in
-        self.starfile_data =  starfileIO.Starfile(self.starfile_in)
-        self.starfile_data.read_star()
+        #read in data_particles datablock from _data.star type file, and split into microtubule blocks (list of dictionaries)
+        self.load_iteration(starfile_in)
         self.apix = float(self.starfile_data.get_entry('data_optics', 'rlnImagePixelSize')[0])
-        #split data into microtubule blocks (list of dictionaries)
-        self._data = self._get_microtubules()
-        self.mt_tot = len(self._data)
         #supress scipy warnings with linear regression
         warnings.filterwarnings('ignore')
 
+    #load the particles from a _data.star file (or a Starfile). For a file with the same particles in the same order as the previous one
+    #(e.g. a later iteration of the same Class3D job), only the changed labels are updated
+    def load_iteration(self, starfile_in):
+        self.starfile_in = starfile_in
+        #starfile data already read in (e.g. from Microtubules.from_arrow)
+        if isinstance(starfile_in, starfileIO.Starfile):
+            self.starfile_in = starfile_in.starfile
+            self.starfile_data = starfile_in
+            self._data = self._get_microtubules()
+        elif self.pipeline or self.max_memory:
+            #microtubules are streamed from the starfile by each vote, so only the other datablocks are read here
+            self.starfile_data = external_sort.read_header(self.starfile_in)
+            self._data = None
+        else:
+            key = self._cache_key()
+            cached = dataset_cache.get(key) if dataset_cache is not None else None
+            if cached:
+                self._data = self._restore(cached)
+            else:
+                self.starfile_data =  starfileIO.Starfile(self.starfile_in)
+                self.starfile_data.read_star(self.compact)
+                self._data = self._get_microtubules()
+                if dataset_cache is not None:
+                    dataset_cache.put(key, (collections.OrderedDict(self.starfile_data._datablocks), self._layout, dict(self._columns)))
+        self.mt_tot = len(self._data) if self._data is not None else None
+
 
     
     ###### I/O methods ######
@@ -62,112 +112,220 @@ class Microtubules:
             with open(self.stdout, 'a') as f:
                 f.write(content)
 
-    #Take RELION v3.1 stafile, convert particle datablock (dictionary of lists) to microtubules (list of dictionaries)
+    #Take RELION v3.1 stafile, convert particle datablock (dictionary of lists) to microtubules (list of dictionaries).
+    #if a starfile was loaded before (e.g. an earlier iteration of the same Class3D job), and the particles put in its sort
+    #order have the same image names, micrographs, tube IDs and track lengths (the sort keys), the sort order and grouping are
+    #reused rather than sorting again, and the sorted columns that have not changed are kept
     def _get_microtubules(self):
-        self.starfile_data.sort_loop_datablock('data_particles', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
         db = self.starfile_data.get_datablock('data_particles')
-        return helper_fns.group_dict_of_list(db, 'rlnMicrographName', 'rlnHelicalTubeID')
-
-    #convert microtubules to particle datablock and save to specified starfile. Destructive of original starfile data
-    def _write_microtubules(self, name):
-        data = self._microtubules_to_particles(self._data)
-        self.starfile_data.add_datablock('data_particles', data)
-        self.starfile_data.write_star(name)
+        particles = None
+        if self._layout is not None and len(self._layout[0]) == self.starfile_data.get_loopdatablock_len('data_particles'):
+            particles = collections.OrderedDict((label, helper_fns.take(data, self._layout[0])) for label, data in db.items())
+            if not all(label in self._columns and same_column(particles[label], self._columns[label]) for label in ('rlnImageName',) + SORT_KEYS):
+                particles = None
+        if particles is None:
+            self._layout = self._particle_layout(db)
+            self._columns = {}
+            particles = collections.OrderedDict((label, helper_fns.take(data, self._layout[0])) for label, data in db.items())
+
+        for label, data in particles.items():
+            if label in self._columns and same_column(data, self._columns[label]):
+                particles[label] = self._columns[label]
+        self._columns = dict(particles)
+        self.starfile_data.add_datablock('data_particles', particles)
+        return self._group(particles, self._layout[1])
+
+    #split sorted particles into microtubules at offsets
+    def _group(self, particles, offsets):
+        return [collections.OrderedDict((label, data[lo:hi]) for label, data in particles.items()) for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+    #key of a starfile in the dataset cache, which changes if the file is changed
+    def _cache_key(self):
+        stat = os.stat(self.starfile_in)
+        return (os.path.abspath(self.starfile_in), stat.st_size, stat.st_mtime_ns, self.compact)
+
+    #make microtubules from the datablocks, sort order and sorted columns of a starfile cached by an earlier job. Microtubules
+    #and datablocks are copied, so that votes (which replace, rather than change, the sorted columns) leave the cache unchanged
+    def _restore(self, cached):
+        datablocks, self._layout, columns = cached
+        self._columns = dict(columns)
+        self.starfile_data = starfileIO.Starfile(self.starfile_in)
+        for key, datablock in datablocks.items():
+            self.starfile_data.add_datablock(key, collections.OrderedDict(datablock))
+        return self._group(self.starfile_data.get_datablock('data_particles'), self._layout[1])
+
+    #sort the particles by micrograph, microtubule and track length. Returns the sort order, and the index of the first particle
+    #of each microtubule in sorted order, followed by the total number of particles
+    def _particle_layout(self, db):
+        columns = [db[label].tolist() if starfileIO.is_array(db[label]) else db[label] for label in SORT_KEYS]
+        keys = list(zip(*columns))
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        tubes = [keys[i][:2] for i in order]
+        offsets = [0] + [i for i in range(1, len(tubes)) if tubes[i] != tubes[i-1]] + [len(tubes)] if tubes else [0]
+        return order, offsets
+
+    #the microtubules to vote on, in chunks (lists of microtubules). Loaded microtubules are a single chunk. Otherwise
+    #microtubules are streamed from the starfile, and decoded and grouped into chunks of whole micrographs (one micrograph at a
+    #time unless pipelined). When pipelined, this is done in a background thread.
+    #Input already sorted by micrograph, tube and track length (checked by a scan of the sort keys) is read as it is voted on.
+    #Otherwise all particle rows must be read and sorted (in memory, or in bounded memory with max_memory) before the first
+    #chunk, and only decoding, voting and writing overlap
+    def _tube_chunks(self):
+        if self._data is not None:
+            if self._data:
+                yield self._data
+            return
+        _, mts = external_sort.stream_microtubules(self.starfile_in, self.max_memory or float('inf'), star=self.starfile_data)
+        chunks = pipeline.micrograph_chunks(mts, self.pipeline or 1)
+        for chunk in pipeline.background(chunks) if self.pipeline else chunks:
+            self._reset_labels(chunk, self._resets)
+            yield chunk
+
+    #vote on each chunk of microtubules with vote(mts, first, out), where first is the index of the first microtubule of the chunk,
+    #and out is a StarWriter (writing in a background thread when pipelined). If outfile is given, vote returns the microtubules
+    #to keep, which are written to outfile. Loaded microtubules are then replaced by them, and streamed votes read outfile next.
+    #Returns the number of microtubules voted on
+    def _vote_chunks(self, vote, outfile=None):
+        kept = []
+        total = 0
+        with pipeline.StarWriter(self.starfile_data, background=bool(self.pipeline)) as out:
+            for mts in self._tube_chunks():
+                corrected = vote(mts, total, out)
+                total += len(mts)
+                if outfile is None:
+                    continue
+                if corrected:
+                    out.write(outfile, self._microtubules_to_particles(corrected))
+                if self._data is not None:
+                    kept += corrected
+            if outfile is not None and not out.names:
+                out.write(outfile, collections.OrderedDict((label, []) for label in self.starfile_data.get_labels('data_particles')))
+        if outfile is not None and self._data is not None:
+            self._data = kept
+            if kept:
+                self.starfile_data.add_datablock('data_particles', self._microtubules_to_particles(kept))
+        elif outfile is not None:
+            self.starfile_in = outfile
+            self._resets = []
+        return total
+
+    def _progress(self, ix):
+        if not self.show_progress:
+            return
+        if self.mt_tot is None:
+            self._add_stdout('Correcting microtubule %i' % ix, True)
+        else:
+            self._add_stdout('Correcting microtubule %i of %i' % (ix, self.mt_tot), True)
 
 
 
     
+    #per-microtubule plots, as one vector figure per microtubule, or as compact rasterised contact sheets if plot_options are set.
+    #fmt None turns per-microtubule plots off
+    def set_plot_options(self, fmt='png', grid=6, dpi=60, max_mb=None):
+        self.plot_options = {'fmt': fmt, 'grid': grid, 'dpi': dpi, 'max_mb': max_mb}
+
+    def _tube_pages(self, name):
+        return plotting.tube_pages('%s/%s' % (self.job_path, name), self.plot_options)
+
+    def _close_tube_pages(self, pages):
+        pages.close()
+        if pages.skipped:
+            self._add_stdout('\nPlot size limit reached, %i microtubules were not plotted to %s.' % (pages.skipped, pages.name), False)
+
+
+
     ###### Protofilament number correction ######
+    #all microtubules are smoothened, split and voted on at once, as segmented array operations over the particles of every microtubule
     def vote_pf_number(self, cutoff):
         self._add_stdout('\nMiRP - voting on protofilament number for microtubules in %s...\n\n' %  self.starfile_in, False)
         cutoff = float(cutoff)
-        split_mts = []
+        min_len = 5
         confidence_data = []
-        plot_pdf = PdfPages('%s/protofilament_corrected.pdf' % self.job_path)                
+        uncorr_class, corr_class = collections.Counter(), collections.Counter()
+        counts = collections.Counter()
+        names = set()
+        plot_pdf = self._tube_pages('protofilament_corrected')
+
+        def vote(mts, first, out):
+            particles = self._microtubules_to_particles(mts)
+            offsets = self._offsets(mts)
+            classes = np.asarray(particles['rlnClassNumber'], dtype=np.int64)
+            uncorr_class.update(classes.tolist())
+            #microtubules shorter than min_len (and so any microtubules split from them) can not pass, so remove them before any other work
+            too_short = np.diff(offsets) < min_len
+            counts['too_short'] += int(too_short.sum())
+            keep = np.repeat(~too_short, np.diff(offsets))
+            index = np.flatnonzero(keep)
+            uncorr_data = classes[index]
+            starts = np.concatenate(([0], np.cumsum(np.diff(offsets)[~too_short])))
 
-        #for each microtubule find the most common (modal) class number 
-        for ix, microtubule in enumerate(self._data):
-            self._add_stdout('Correcting microtubule %i of %i' % (ix, self.mt_tot), True)
-            uncorr_data = microtubule['rlnClassNumber']
-            mts_to_plot = {'uncorrected':uncorr_data, 'corrected':[]}
-            
             #method to split microtubules where a significant switch in class assignment occurs
             #smoothen class numbers by taking the mode for each particle over a seven particle window
-            smoothened_data = self._mode_smoothen(uncorr_data)
-            #if there is a change in class number, split the microtubule microtubule at the index of the change
-            nmts = self._split_mt_on_change(microtubule, smoothened_data)
-
-            #for each 'new' microtubule (however, if data is good, most microtuubles should not be split) determine protofilament number
-            for mt in nmts:
-                #vote on the modal class assigmnment
-                confidence = self._vote_mode(mt, 'rlnClassNumber')
-                #remove very short microtubules
-                if self._microtubule_len(mt) < 5:
-                    pass
-                #remove microtubules with a low confidence in class assignment
-                elif confidence < cutoff:
-                    confidence_data.append(confidence)
-                else:
-                    confidence_data.append(confidence)
-                    mts_to_plot['corrected'].append(mt['rlnClassNumber'])
-                    #renumber microtubules, since split microtubules increase the total
-                    mt = self._renumber_tube_id(split_mts, mt)
-                    split_mts.append(mt)
-            self._plot_pf_number_corrected(mts_to_plot, plot_pdf)
-        plot_pdf.close()
+            smoothened_data = helper_fns.segmented_window_mode(uncorr_data, starts, 3, 4)
+            #if there is a change in class number, split the microtubule at the index of the change
+            change = np.zeros(len(uncorr_data), dtype=bool)
+            change[1:] = smoothened_data[1:] != smoothened_data[:-1]
+            change[starts[:-1]] = True
+            split = np.append(np.flatnonzero(change), len(uncorr_data))
+            split_len = np.diff(split)
+
+            #for each 'new' microtubule (however, if data is good, most microtuubles should not be split) vote on the modal class
+            #assignment. Remove very short microtubules, and those with a low confidence in class assignment
+            mode, freq = helper_fns.segmented_mode(uncorr_data, split)
+            confidence = freq / split_len * 100
+            long_enough = split_len >= min_len
+            confidence_data.extend(confidence[long_enough].tolist())
+            passed = long_enough & (confidence >= cutoff)
+            counts['low_confidence'] += int((long_enough & ~passed).sum())
+
+            #plot the uncorrected class numbers of each microtubule, and the corrected class numbers of each passing microtubule split from it
+            first_split = np.searchsorted(split, starts)
+            for lo, hi, slo, shi in zip(starts[:-1], starts[1:], first_split[:-1], first_split[1:]):
+                mts_to_plot = {'uncorrected': uncorr_data[lo:hi].tolist(),
+                               'corrected': [[mode[i]] * split_len[i] for i in range(slo, shi) if passed[i]]}
+                self._plot_pf_number_corrected(mts_to_plot, plot_pdf)
+
+            #keep the particles of passing microtubules, with every class assignment replaced by the modal class
+            passed_ptcls = np.repeat(passed, split_len)
+            corr = collections.OrderedDict((label, helper_fns.take(data, index[passed_ptcls])) for label, data in particles.items())
+            corr_mts = int(passed.sum())
+            counts['corr_total_mts'] += corr_mts
+            if not corr_mts:
+                return
+            corr['rlnClassNumber'] = np.repeat(mode[passed], split_len[passed]).tolist()
+            corr_class.update(corr['rlnClassNumber'])
+            #renumber microtubules in each micrograph, since split microtubules increase the total
+            corr_starts = np.cumsum(np.concatenate(([0], split_len[passed])))
+            _, mgph_starts = helper_fns.run_codes([corr['rlnMicrographName'][i] for i in corr_starts[:-1]])
+            tubeid = helper_fns.segment_positions(np.append(mgph_starts, corr_mts))
+            corr['rlnHelicalTubeID'] = np.repeat(tubeid, split_len[passed]).tolist()
+
+            #sort and separate microtubules by class number, and save to separate starfiles for each protofilament number.
+            #chunks are whole micrographs in sorted order, so each starfile stays sorted as chunks are added
+            corr = helper_fns.sort_dict_of_list(corr, 'rlnClassNumber')
+            for pf in helper_fns.group_dict_of_list(corr, 'rlnClassNumber'):
+                pf = helper_fns.sort_dict_of_list(pf, 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
+                fname = '%s/1%ipf_data.star' % (self.job_path, pf['rlnClassNumber'][0])
+                out.write(fname, pf)
+                names.add(fname)
+
+        uncorr_total_mts = self._vote_chunks(vote)
+        self._close_tube_pages(plot_pdf)
+        self._add_stdout('\n%i microtubules shorter than %i particles were removed.' % (counts['too_short'], min_len), False)
         self._plot_confidence(confidence_data, cutoff)
-        
-        #sort and separate microtubules by class number, and save to separate starfiles for each protofilament number
-        particles = self._microtubules_to_particles(split_mts)
-        particles = helper_fns.sort_dict_of_list(particles, 'rlnClassNumber')   
-        pf_seg = helper_fns.group_dict_of_list(particles, 'rlnClassNumber')
-        self._add_stdout('\nWrote ', False)
-        for pf in pf_seg:
-            self.starfile_data.add_datablock('data_particles', pf)
-            self.starfile_data.sort_loop_datablock('data_particles', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
-            fname = '%s/1%ipf_data.star' % (self.job_path, self.starfile_data.get_entry('data_particles', 'rlnClassNumber')[0])
-            self.starfile_data.write_star(fname)
-            self._add_stdout('%s, ' % fname, False)
-        self._pf_number_stats(self._data, split_mts)
-
-    #function for renumbering expanded microtubules in micrograph (where microtubules have been split, e.g. based on protofilament number changes) 
-    def _renumber_tube_id(self, mts, mt):
-        try:
-            prev_mgph = mts[-1]['rlnMicrographName'][0]
-            curr_mgph = mt['rlnMicrographName'][0]
-            if curr_mgph == prev_mgph:
-                prev_tubeid = int(mts[-1]['rlnHelicalTubeID'][0])
-                curr_tubeid = prev_tubeid + 1
-            else:
-                curr_tubeid = 1
-        except IndexError:
-            curr_tubeid = 1
-        
-        mt['rlnHelicalTubeID'] = [curr_tubeid for _ in range(self._microtubule_len(mt))]
-        return mt
-
-    #Calcualte the percentage of different protofilament numbers in uncorrected and corrected data. 
-    def _pf_number_stats(self, uncorr_mts, corr_mts):
-
-        def per(frac, total):
-            return (frac / total) * 100
-
-        uncorr_total_mts = len(uncorr_mts)
-        uncorr_total_ptcls = self._get_total_particle_number(uncorr_mts)
-        corr_total_ptcls = self._get_total_particle_number(corr_mts)
-        corr_total_mts = len(corr_mts)
-
-        uncorr_class = collections.Counter(self._get_global_data(uncorr_mts, 'rlnClassNumber'))
-        corr_class = collections.Counter(self._get_global_data(corr_mts, 'rlnClassNumber'))
-        
-        stats = starfileIO.Starfile('%s/pf_number_sorting_stats.star' % self.job_path)
-        gen = {'rlnTotalNumberTubes': uncorr_total_mts,
-               'mirpTotalNumberTubes': corr_total_mts}
-        pf = {'mtProtofilamentNumber': [11, 12, 13, 14, 15, 16],
-              'rlnClassDistribution': [per(uncorr_class[i], uncorr_total_ptcls) for i in range(1, 7)],
-              'mirpClassDistribution': [per(corr_class[i], corr_total_ptcls) for i in range(1, 7)]}
-        stats.add_datablock('data_general', gen)
-        stats.add_datablock('data_percent_protofilament_number', pf)
+        if names:
+            self._add_stdout('\nWrote ', False)
+            for fname in sorted(names):
+                self._add_stdout('%s, ' % fname, False)
+        self._pf_number_stats(uncorr_total_mts, uncorr_class, counts['corr_total_mts'], corr_class, counts['too_short'],
+                              counts['low_confidence'])
+
+    #Calcualte the percentage of different protofilament numbers in uncorrected and corrected data, from the number of microtubules
+    #and the number of particles in each class
+    def _pf_number_stats(self, uncorr_total_mts, uncorr_class, corr_total_mts, corr_class, too_short, low_confidence):
+        stats = pf_number_stats(uncorr_total_mts, corr_total_mts, sum(uncorr_class.values()), sum(corr_class.values()),
+                                uncorr_class, corr_class, too_short, low_confidence)
         stats.write_star('%s/pf_number_sorting_stats.star' % self.job_path)
 
         pfnums = stats.get_entry('data_percent_protofilament_number', 'mtProtofilamentNumber')
@@ -188,7 +346,9 @@ class Microtubules:
         corr_xaxs = [ [i for i in range(1, len(y)+1 )] for y in corr_yaxs]
         
         total_plots = len(corr_yaxs) + 1
-        fig=plt.figure()
+        fig = pdfpages.new_figure()
+        if fig is None:
+            return
         ax1 = fig.add_subplot(1, total_plots+1, 1)
         ax1.set_title('Uncorrected')
         ax1.plot(uncorr_xax, uncorr_yax, 'o')
@@ -203,9 +363,7 @@ class Microtubules:
             ax.set_xticks = corr_xaxs[i-1]
             ax.plot(corr_xaxs[i-1], corr_yaxs[i-1], 'o')
 
-        plt.tight_layout()
         pdfpages.savefig(fig)
-        plt.close()
 
 
 
@@ -213,20 +371,19 @@ class Microtubules:
     def vote_on_rot(self):
         self._add_stdout('\nMiRP - voting on Rotation angle for microtubules in %s...\n\n' %  self.starfile_in, False)
         cutoff = 8
-        corrected_mts = []
-        mts_to_remove = 0
         confidence = []
-        plot_pdf = PdfPages('%s/rotation_corrected.pdf' % self.job_path)                
+        plot_pdf = self._tube_pages('rotation_corrected')
 
         #for each microtubule, find the most commonly assigned (modal) Rot angle, whilst accounting for the slope of microtubule supertwist
-        for ix, microtubule in enumerate(self._data):
-            self._add_stdout('Correcting microtubule %i of %i' % (ix, self.mt_tot), True)
-            rot_angles = microtubule['rlnAngleRot']
-            modal_clust, outliers = self._cluster_shallow_slopes(rot_angles, cutoff)
-            #remove any microtubules for which clusters cannot be find (low particle number microtubules, or with widely distributed Rot angles)
-            if not modal_clust:
-                mts_to_remove += 1
-            else:
+        def vote(mts, first, out):
+            corrected_mts = []
+            for ix, microtubule in enumerate(mts, first):
+                self._progress(ix)
+                rot_angles = microtubule['rlnAngleRot']
+                modal_clust, outliers = self._cluster_shallow_slopes(rot_angles, cutoff)
+                #remove any microtubules for which clusters cannot be find (low particle number microtubules, or with widely distributed Rot angles)
+                if not modal_clust:
+                    continue
                 #correct the particle Rot angles to follow the fitted straight line of the modal Rot angle cluster
                 #calculate confidence in Rot angle assignment (will always be low)
                 c = len(modal_clust) / self._microtubule_len(microtubule) * 100
@@ -242,14 +399,15 @@ class Microtubules:
                 microtubule['rlnAnglePsiPrior'] = fit
                 corrected_mts.append(microtubule)
                 self._plot_rot_vote(outliers, rot_angles, microtubule['rlnAngleRot'], plot_pdf)
-        plot_pdf.close()
+            return corrected_mts
 
-        self._plot_confidence(confidence, 0)
-        self._add_stdout('\n%s microtubules could not be fitted and were removed.' % mts_to_remove, False)
-        self._data = corrected_mts
         self.outfile = '%srotCorrected_data.star' % self.job_path
+        total = self._vote_chunks(vote, self.outfile)
+        self._close_tube_pages(plot_pdf)
+
+        self._plot_confidence(confidence, 0)
+        self._add_stdout('\n%s microtubules could not be fitted and were removed.' % (total - len(confidence)), False)
         self._add_stdout('\nWrote %s' % self.outfile, False)
-        self._write_microtubules(self.outfile)
 
     #for each microtubule, plot the uncorrected Rot angles, with straight lines demonstrating the clusters found
     #then plot the corrected Rot angle
@@ -257,7 +415,9 @@ class Microtubules:
         xax = [i for i in range(1, len(uncorr)+1)]
         yticks = [i for i in range(-180, 180 + 1, 40) ]
 
-        fig = plt.figure()
+        fig = pdfpages.new_figure()
+        if fig is None:
+            return
         ax1 = fig.add_subplot(1, 2, 1)
         ax1.set_title('Uncorrected + Clusters')
         ax1.plot(xax, uncorr, 'o')
@@ -280,53 +440,52 @@ class Microtubules:
         ax2.set_xticks = xax
         ax2.set_xlabel('Particle Number')
 
-        plt.tight_layout()
         pdfpages.savefig(fig)
-        plt.close()
 
 
 
     ###### X/Y shift correction ######
     def vote_on_xy(self, cutoff):
         self._add_stdout('\nMiRP - voting on X/Y shifts for microtubules in %s...\n\n' %  self.starfile_in ,False)
-        plot_pdf = PdfPages('%s/XY_corrected.pdf' % self.job_path)                
-        corrected_mts = []
+        plot_pdf = self._tube_pages('XY_corrected')
 
         #for each microtubule pick the most populated linear region in the X/Y-shifts, and force all shifts to follow that line
-        for ix, microtubule in enumerate(self._data):
-            try:
-                #remove these parameters as they can work against MiRP Rot angle assignment
-                del microtubule['rlnAnglePsiFlipRatio']
-            except KeyError:
-                pass
-            self._add_stdout('Correcting microtubule %i of %i' % (ix, self.mt_tot), True)
-            Xsh, Ysh = microtubule['rlnOriginXAngst'], microtubule['rlnOriginYAngst']
-            #find most populated linear region (modal cluster)
-            Xmodal_clust = max(self._cluster_breaks(Xsh, cutoff), key = len)
-            Ymodal_clust = max(self._cluster_breaks(Ysh, cutoff), key = len)
-            if Xmodal_clust == [0]:
-                Xcorr = [0 for x in range(1, len(Xsh)+1)]
-                Ycorr = [0 for x in range(1, len(Ysh)+1)]
-            else:
-                #linear regression to get slope and y-intercept of modal cluster, and correct shifts based on this
-                Xcorr = self._fit_eulerXY(Xsh, Xmodal_clust)
-                Ycorr = self._fit_eulerXY(Ysh, Ymodal_clust)
-            microtubule['rlnOriginXAngst'] = Xcorr
-            microtubule['rlnOriginYAngst'] = Ycorr
-            self._plot_xy_vote(Xsh, Ysh, Xcorr, Ycorr, plot_pdf)
-            corrected_mts.append(microtubule)
-        plot_pdf.close()
-
-        self._data = corrected_mts        
+        def vote(mts, first, out):
+            for ix, microtubule in enumerate(mts, first):
+                try:
+                    #remove these parameters as they can work against MiRP Rot angle assignment
+                    del microtubule['rlnAnglePsiFlipRatio']
+                except KeyError:
+                    pass
+                self._progress(ix)
+                Xsh, Ysh = microtubule['rlnOriginXAngst'], microtubule['rlnOriginYAngst']
+                #find most populated linear region (modal cluster)
+                Xmodal_clust = max(self._cluster_breaks(Xsh, cutoff), key = len)
+                Ymodal_clust = max(self._cluster_breaks(Ysh, cutoff), key = len)
+                if Xmodal_clust == [0]:
+                    Xcorr = [0 for x in range(1, len(Xsh)+1)]
+                    Ycorr = [0 for x in range(1, len(Ysh)+1)]
+                else:
+                    #linear regression to get slope and y-intercept of modal cluster, and correct shifts based on this
+                    Xcorr = self._fit_eulerXY(Xsh, Xmodal_clust)
+                    Ycorr = self._fit_eulerXY(Ysh, Ymodal_clust)
+                microtubule['rlnOriginXAngst'] = Xcorr
+                microtubule['rlnOriginYAngst'] = Ycorr
+                self._plot_xy_vote(Xsh, Ysh, Xcorr, Ycorr, plot_pdf)
+            return mts
+
         self.outfile = '%sxyCorrected_data.star' %  self.job_path
+        self._vote_chunks(vote, self.outfile)
+        self._close_tube_pages(plot_pdf)
         self._add_stdout('\nWrote %s' % self.outfile, False)
-        self._write_microtubules(self.outfile)    
     
     #for each microtubule, plot uncorrected and corrrected X/Y-shifts
     def _plot_xy_vote(self, Xuncorr, Yuncorr, Xcorr, Ycorr, pdfpages):
         xax = [i for i in range(1, len(Xuncorr)+1)]
 
-        fig = plt.figure()
+        fig = pdfpages.new_figure()
+        if fig is None:
+            return
         ax1 = fig.add_subplot(1, 2, 1)
         ax1.set_title('Uncorrected')
         ax1.plot(xax, Xuncorr, 'o')
@@ -343,35 +502,37 @@ class Microtubules:
         ax2.set_xticks = xax
         ax2.set_xlabel('Particle Number')
         
-        plt.tight_layout()
         pdfpages.savefig(fig)
-        plt.close()
 
 
 
     ###### Seam Checking ######
     def vote_on_seam(self, cutoff, pfnum, rise):
         self._add_stdout('\nMiRP - voting on relative seam position...\n\n', False)
-        confidence_data = []
-        new_mts = []
         cutoff = float(cutoff)
         pfnum = int(pfnum)
         rise = float(rise)
-        
-        #for each microtubule, calculate the modal class from 3D seam classification, and use this to correct the seam position relative to the 3D reference
-        for ix, microtubule in enumerate(self._data):
-            self._add_stdout('Correcting microtubule %i of %i' % (ix, self.mt_tot), True)
-            mt_len = self._microtubule_len(microtubule)
-            #get modal class for this microtubule, and confidence in class assignment 
-            class_assignment = microtubule['rlnClassNumber']
-            class_distribution = collections.Counter(class_assignment)
-            top_class, top_class_freq = class_distribution.most_common(1)[0]
-            confidence = top_class_freq / mt_len * 100
-
-            #remove microtubules with lower confidence than the cutoff 
-            if confidence < cutoff:
-                confidence_data.append(confidence)
-            else:
+        confidence_data = []
+        distribution = collections.Counter()
+
+        def vote(mts, first, out):
+            new_mts = []
+            #confidence in class assignment (percentage of particles in the modal class) for every microtubule at once, so that
+            #microtubules with lower confidence than the cutoff are removed before any per-microtubule work
+            offsets = self._offsets(mts)
+            lengths = np.diff(offsets)
+            confidence = (helper_fns.segmented_mode(self._get_global_data(mts, 'rlnClassNumber'), offsets)[1] / lengths * 100).tolist()
+            confidence_data.extend(confidence)
+
+            #for each microtubule, calculate the modal class from 3D seam classification, and use this to correct the seam position relative to the 3D reference
+            for ix, microtubule in enumerate(mts, first):
+                if confidence[ix - first] < cutoff:
+                    continue
+                self._progress(ix)
+                mt_len = self._microtubule_len(microtubule)
+                #get modal class for this microtubule
+                top_class = int(collections.Counter(microtubule['rlnClassNumber']).most_common(1)[0][0])
+
                 # correct microtubules with alpha/beta-tubulin out of register
                 if top_class > pfnum:
                     self._shift_along_z(microtubule, 41)  
@@ -379,46 +540,31 @@ class Microtubules:
                     microtubule['rlnClassNumber'] = [top_class - pfnum for _ in range(mt_len)]
                 else:
                     microtubule['rlnClassNumber'] = [top_class for _ in range(mt_len)]
-                confidence_data.append(confidence)
                 # correct the rot angle based on the modal class
                 self._correct_pfregister(pfnum, rise, microtubule)
+                distribution.update(microtubule['rlnClassNumber'])
                 new_mts.append(microtubule)
-        
-        self._plot_confidence(confidence_data, cutoff)
-        self._plot_seam_stats(new_mts)
-        self._data = new_mts
+            return new_mts
+
         self.outfile = '%sseamCorrected_data.star' % self.job_path
-        self._write_microtubules(self.outfile)
+        self._vote_chunks(vote, self.outfile)
+        low_confidence = sum(c < cutoff for c in confidence_data)
+        self._add_stdout('\n%i microtubules below the confidence cutoff were removed.' % low_confidence, False)
+        self._plot_confidence(confidence_data, cutoff)
+        self._plot_seam_stats(distribution, low_confidence)
         self._add_stdout('\nWrote %s' % self.outfile, False)
 
-    def _plot_seam_stats(self, microtubules):
-        #plot the percentage of particles in each relative seam position
-        particles = self._microtubules_to_particles(microtubules)
-        size = self._get_total_particle_number(microtubules)
-        distribution = collections.Counter(particles['rlnClassNumber'])
-
-        stats = []
-        for k in distribution:
-            p = distribution[k] / size * 100
-            stats.append( (k, p) )
-        stats.sort(key=operator.itemgetter(0))
-        seamclass = [i[0] for i in stats]
-        freq = [i[1] for i in stats]
-
-        #write a star file describing the relative seam position distribution
-        stats_star = starfileIO.Starfile('seamcorrection_stats.star')
-        stats_star.add_datablock('seam_class_distribution', {'seamClassNumber': seamclass, 'percentDistribution': freq})
+    #plot the percentage of particles in each relative seam position, from the number of particles in each class
+    def _plot_seam_stats(self, distribution, low_confidence):
+        #write a star file describing the relative seam position distribution, and the microtubules removed before correction
+        stats_star = seam_stats(distribution, low_confidence)
         stats_star.write_star('%s/seamcorrection_stats.star' % self.job_path)
-
-        plt.bar([i for i in range(1, len(freq)+1)], freq)
-        plt.xlabel('Seam Class')
-        plt.ylabel('Percent of Data')
-        plt.savefig('%s/seamclass_distribution.pdf' % self.job_path)
-        plt.close()
+        plot_seam_stats(stats_star, '%s/seamclass_distribution.pdf' % self.job_path)
 
     #use seam classification results to calculate seam postion relative to the 3D reference, and correct the Rot angle and X/Y shifts accordingly
     def _correct_pfregister(self, pfnum, rise, mt):
         #convert class number to relaive seam position (e.g. -6 to 7 for 14 protofilament microtubule)
+        self._promote(mt, 'rlnAngleRot', 'rlnAngleRotPrior')
         seampos = convert_pfnum_to_semicircle(mt['rlnClassNumber'][0], pfnum)
         twist = (360 / pfnum)
         #calculate the change in rotation angle needed to correct the seam position
@@ -436,6 +582,7 @@ class Microtubules:
 
     #translate particles along the microtubule z-axis using psi angle and desired z-axis translation (hypotenuse) to edit the x/y shifts
     def _shift_along_z(self, mt, shift):
+        self._promote(mt, 'rlnOriginXAngst', 'rlnOriginYAngst')
         for i in range(self._microtubule_len(mt)):
             psi = mt['rlnAnglePsi'][i]
             xsh = mt['rlnOriginXAngst'][i]
@@ -447,78 +594,76 @@ class Microtubules:
             
 
     ###### Microtubule operations ######
-    #takes any number of relion labels and sets their values to zero
+    #takes any number of relion labels and sets their values to zero. When streamed, they are reset in each chunk as it is read
     def reset_eulerxy(self, *rln_labels):
+        if self._data is None:
+            self._resets += rln_labels
+        else:
+            self._reset_labels(self._data, rln_labels)
+
+    def _reset_labels(self, microtubules, rln_labels):
        for label in rln_labels:
             #for Tilt, values a set to 90 degrees
            if label == 'rlnAngleTilt':
-               for mt in self._data:
+               for mt in microtubules:
                    mt_len = self._microtubule_len(mt)
                    mt['rlnAngleTilt'] = [90 for _ in range(mt_len)]
            #for Psi, angles are set to their prior (so that after round of protofilament classification, they can be reset to picking angle)
            elif label == 'rlnAnglePsi':
-               for mt in self._data:
+               for mt in microtubules:
                    mt_len = self._microtubule_len(mt)
                    mt['rlnAnglePsi'] = [mt['rlnAnglePsiPrior'][i] for i in range(mt_len)]
            else:
-               for mt in self._data:
+               for mt in microtubules:
                    mt_len = self._microtubule_len(mt)
                    mt[label] = [0 for _ in range(mt_len)]
 
-    #for one data entry, get all the data from all the microtubules and return as a list
+    #return the microtubule with a given micrograph and tube ID, or None if there is none. Loaded microtubules are looked up in a
+    #dictionary built on first use, and pipelined microtubules are read from the current starfile through its on-disk tube index
+    def get_tube(self, micrograph, tube_id):
+        if self._data is None:
+            return starfileIO.Starfile(self.starfile_in).get_tube(micrograph, tube_id)
+        if self._tube_lookup[0] is not self._data:
+            self._tube_lookup = (self._data, {(mt['rlnMicrographName'][0], int(mt['rlnHelicalTubeID'][0])): mt for mt in self._data})
+        return self._tube_lookup[1].get((micrograph, tube_id))
+
+    #for one data entry, get all the data from all the microtubules and return as a list (or an array, for compact arrays)
     def _get_global_data(self, microtubules, label):
-        data = []
-        for mt in microtubules:
-            data += mt[label]
-        return data
+        return helper_fns.concat(mt[label] for mt in microtubules)
+
+    #replace compact arrays of a microtubule with lists of Python numbers before changing their values in place, so that changes
+    #are computed in double precision, and do not change arrays shared with other microtubules
+    def _promote(self, mt, *labels):
+        for label in labels:
+            if label in mt and starfileIO.is_array(mt[label]):
+                mt[label] = mt[label].tolist()
+
+    #for one data entry, get the data from all the microtubules as a single array, in microtubule order
+    def get_column(self, label):
+        return np.asarray(self._get_global_data(self._data, label))
 
     #convert from list of dictionaries (microtubules) to particles (dictionary of lists)
     def _microtubules_to_particles(self, mts):
-        data = {k:[] for k in mts[0].keys()}
-        for mt in mts:
-            for key in mt.keys():
-                data[key] += list(mt[key])
-        return data
+        return {k: helper_fns.concat(mt[k] for mt in mts) for k in mts[0].keys()}
+
+    #return the index of the first particle of each microtubule in the concatenated particle data, followed by the total number of particles
+    def get_offsets(self):
+        return self._offsets(self._data)
+
+    def _offsets(self, microtubules):
+        lengths = [self._microtubule_len(mt) for mt in microtubules]
+        return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
 
     #return the number of particles in a given microtubule
     def _microtubule_len(self, microtubule):
         return len(microtubule['rlnHelicalTubeID'])
 
-    #return to the total number of particles for the given list of microtubules
-    def _get_total_particle_number(self, mts):
-        data = self._microtubules_to_particles(mts)
-        return len(data['rlnHelicalTubeID'])
-
 
 
     ###### Methods for microtubule angle, shift, and class correction ######
-    #for a list of numbers (e.g. class assignment for a microtubule), smoothen the numbers by calculating the mode over a window of 7
-    def _mode_smoothen(self, data):
-        smoothened = []
-        for i, _ in enumerate(data):
-            l, h = helper_fns.get_window(i, 3, 4, len(data))
-            smoothened.append(int(stats.mode(data[l:h])[0]))
-        return smoothened
-
-    #for data from a microtubule, split the microtubule where changes in data value occur
-    def _split_mt_on_change(self, microtubule, data):
-        changes = []
-        for index, (curr, nxt) in enumerate( zip(data[:-1], data[1:]) ):
-            if curr - nxt != 0:
-                changes.append(index+1)
-        return helper_fns.split_dict_of_list(microtubule, changes)
-
-    #find the modal value for a data entry in a microtubule, and change all values in the data entry to this. Return the confidence in the mode
-    def _vote_mode(self, microtubule, label):
-        mt_len = self._microtubule_len(microtubule)
-        mode, freq = collections.Counter(microtubule[label]).most_common(1)[0]
-        microtubule[label] = [mode for _ in range(mt_len)]
-        confidence = freq / mt_len * 100
-        return confidence
-
     #for a list of y-values, extract the desired values statedd in xax_data_tofit, and perform linear regression on them. Fit and return all values to this equation.
     def _fit_eulerXY(self, ydata, xax_data_tofit):
-        yax_data_tofit = [ydata[x] for x in xax_data_tofit]
+        yax_data_tofit = [float(ydata[x]) for x in xax_data_tofit]
         slope, yincept = stats.linregress(xax_data_tofit, yax_data_tofit)[0:2]
         return [yincept + x*slope for x in range(1, len(ydata)+1)]
 
@@ -551,7 +696,7 @@ class Microtubules:
     #find the most populated linear region in 2D data
     #by calculating residuals betwee neighbours, and creating clusters where the boundaries are defined by residuals that are outside a cutoff
     def _cluster_breaks(self, data, cutoff):
-        diff = [curr - nxt for curr, nxt in zip(data[:-1], data[1:])]
+        diff = [float(curr) - float(nxt) for curr, nxt in zip(data[:-1], data[1:])]
         
         clusters = []
         clust = [0]
@@ -565,15 +710,37 @@ class Microtubules:
         return clusters
 
     #for a PF number of seam classification job, take the list of confidence in MiRP class correction for each microtubule, and plot as a histogram
+    #the confidence values are also saved, so that results from separate runs (e.g. shards) can be combined
     def _plot_confidence(self, confidence, cutoff):
         self._add_stdout('\nPlotting confidence to %s/confidence.pdf...' % self.job_path, False)
-        fq = plt.hist(confidence, bins=10)[0]
-        plt.vlines(cutoff, ymin=0.0, ymax=fq[-1], colors='red', label='cutoff')
-        plt.xlabel('Confidence (percent in modal class)')    
-        plt.xticks=[0,10,20,30,40,50,60,70,80,90,100]
-        plt.ylabel('Frequency')    
-        plt.savefig('%s/confidence.pdf' % self.job_path)
-        plt.close()
+        self.confidence = confidence_stats(confidence, cutoff)
+        self.confidence.write_star('%s/confidence.star' % self.job_path)
+        plot_confidence(confidence, cutoff, '%s/confidence.pdf' % self.job_path)
+
+    ###### Arrow/pandas export ######
+    #return the particles of all microtubules (including any corrections so far) as a pyarrow Table or pandas DataFrame, in
+    #microtubule order. Compact columns that votes have not changed are shared with the sorted particles, without copying. The
+    #offsets of the microtubules (see get_offsets) are kept in the metadata (see starfileIO.arrow_metadata)
+    def _export_starfile(self):
+        assert self._data is not None, 'Microtubules streamed with pipeline or max_memory are not held in memory, so can not be exported.'
+        star = starfileIO.Starfile(self.starfile_in)
+        for key in self.starfile_data._datablocks:
+            star.add_datablock(key, self.starfile_data.get_datablock(key))
+        if self._data:
+            star.add_datablock('data_particles', self._microtubules_to_particles(self._data))
+        return star
+
+    def to_arrow(self):
+        return self._export_starfile().to_arrow('data_particles', self.get_offsets())
+
+    def to_pandas(self):
+        return self._export_starfile().to_pandas('data_particles', self.get_offsets())
+
+    #make Microtubules from a pyarrow Table or pandas DataFrame made by to_arrow or to_pandas (of Microtubules or Starfile),
+    #for voting in job_path
+    @classmethod
+    def from_arrow(cls, table, job_path):
+        return cls(starfileIO.Starfile.from_arrow(table), job_path)
 
     def __repr__(self):
         return 'Microtubule(%s)' % self.starfile_in
@@ -596,4 +763,81 @@ def convert_pfnum_to_semicircle(current_pfnumber, total_pfnumber):
     else:
         return -(total_pfnumber % current_pfnumber) - 1 
 
-    
+
+#whether two loop columns (lists, or compact arrays) have the same values
+def same_column(a, b):
+    if starfileIO.is_array(a) or starfileIO.is_array(b):
+        return np.array_equal(a, b)
+    return a == b
+
+
+#make the protofilament number sorting stats from the number of microtubules, number of particles, and number of particles
+#in each class (collections.Counter), before (rln) and after (mirp) MiRP correction, and the number of microtubules removed
+#for being too short and (after splitting) for low confidence
+def pf_number_stats(uncorr_total_mts, corr_total_mts, uncorr_total_ptcls, corr_total_ptcls, uncorr_class, corr_class,
+                    too_short=0, low_confidence=0):
+
+    def per(frac, total):
+        return (frac / total) * 100
+
+    stats = starfileIO.Starfile('pf_number_sorting_stats.star')
+    gen = {'rlnTotalNumberTubes': uncorr_total_mts,
+           'mirpTotalNumberTubes': corr_total_mts,
+           'rlnTotalNumberParticles': uncorr_total_ptcls,
+           'mirpTotalNumberParticles': corr_total_ptcls,
+           'mirpTooShortTubes': too_short,
+           'mirpLowConfidenceTubes': low_confidence}
+    pf = {'mtProtofilamentNumber': [11, 12, 13, 14, 15, 16],
+          'rlnClassDistribution': [per(uncorr_class[i], uncorr_total_ptcls) for i in range(1, 7)],
+          'mirpClassDistribution': [per(corr_class[i], corr_total_ptcls) for i in range(1, 7)],
+          'rlnClassCount': [uncorr_class[i] for i in range(1, 7)],
+          'mirpClassCount': [corr_class[i] for i in range(1, 7)]}
+    stats.add_datablock('data_general', gen)
+    stats.add_datablock('data_percent_protofilament_number', pf)
+    return stats
+
+
+#make the seam class stats (percentage of particles in each relative seam position) from the number of particles in each class,
+#and the number of microtubules removed for low confidence before correction
+def seam_stats(distribution, low_confidence=0):
+    size = sum(distribution.values())
+    stats = []
+    for k in distribution:
+        p = distribution[k] / size * 100
+        stats.append( (k, p, distribution[k]) )
+    stats.sort(key=operator.itemgetter(0))
+    seamclass = [i[0] for i in stats]
+    freq = [i[1] for i in stats]
+    count = [i[2] for i in stats]
+
+    stats_star = starfileIO.Starfile('seamcorrection_stats.star')
+    stats_star.add_datablock('data_general', {'mirpLowConfidenceTubes': low_confidence})
+    stats_star.add_datablock('data_seam_class_distribution', {'seamClassNumber': seamclass, 'percentDistribution': freq, 'seamClassCount': count})
+    return stats_star
+
+#plot the seam class stats as a bar chart
+def plot_seam_stats(stats_star, name):
+    freq = stats_star.get_entry('data_seam_class_distribution', 'percentDistribution')
+    plt.bar([i for i in range(1, len(freq)+1)], freq)
+    plt.xlabel('Seam Class')
+    plt.ylabel('Percent of Data')
+    plt.savefig(name)
+    plt.close()
+
+
+#store the confidence in MiRP class correction for each microtubule, and the cutoff used
+def confidence_stats(confidence, cutoff):
+    stats = starfileIO.Starfile('confidence.star')
+    stats.add_datablock('data_general', {'mirpConfidenceCutoff': cutoff})
+    stats.add_datablock('data_confidence', {'mirpConfidence': list(confidence)})
+    return stats
+
+#plot the confidence in MiRP class correction for each microtubule as a histogram, marking the cutoff
+def plot_confidence(confidence, cutoff, name):
+    fq = plt.hist(confidence, bins=10)[0]
+    plt.vlines(cutoff, ymin=0.0, ymax=fq[-1], colors='red', label='cutoff')
+    plt.xlabel('Confidence (percent in modal class)')    
+    plt.xticks=[0,10,20,30,40,50,60,70,80,90,100]
+    plt.ylabel('Frequency')    
+    plt.savefig(name)
+    plt.close()
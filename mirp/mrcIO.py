@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+mrcIO.py provides reading and writing of MRC2014 format image stacks (.mrcs) and volumes (.mrc).
+Files are read by memory-mapping, so that slices of a particle stack are read from disk only when used,
+and are written in a single pass with a complete header.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import helper_fns
+
+np = helper_fns.np
+
+HEADER_BYTES = 1024
+#MRC mode number to NumPy data type (without byte order)
+MODES = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}
+
+
+class Mrcfile:
+
+    def __init__(self, mrcfile):
+        self.mrcfile = mrcfile
+        self.header = None
+        self.data = None
+
+    #memory-map the data in an existing MRC file. The data is a (nz, ny, nx) array, and is not read until accessed
+    def read_mrc(self):
+        with open(self.mrcfile, 'rb') as f:
+            raw = f.read(HEADER_BYTES)
+        assert len(raw) == HEADER_BYTES, 'Error: %s is too short to be an MRC file.' % self.mrcfile
+        #machine stamp 0x44 0x44 is little-endian, 0x11 0x11 is big-endian
+        byteorder = '>' if raw[212:213] == b'\x11' else '<'
+        ints = np.frombuffer(raw, dtype=byteorder + 'i4', count=56)
+        floats = np.frombuffer(raw, dtype=byteorder + 'f4', count=56)
+        nx, ny, nz, mode = [int(i) for i in ints[0:4]]
+        assert mode in MODES, 'Error: MRC mode %i in %s is not supported.' % (mode, self.mrcfile)
+        self.header = {'nx': nx, 'ny': ny, 'nz': nz, 'mode': mode,
+                       'mx': int(ints[7]), 'my': int(ints[8]), 'mz': int(ints[9]),
+                       'cella': tuple(float(f) for f in floats[10:13]),
+                       'ispg': int(ints[22]), 'nsymbt': int(ints[23])}
+        self.data = np.memmap(self.mrcfile, dtype=byteorder + MODES[mode], mode='r',
+                              offset=HEADER_BYTES + self.header['nsymbt'], shape=(nz, ny, nx))
+        return self.data
+
+    #return the pixel size in angstrom, from the unit cell dimensions
+    def get_apix(self):
+        return self.header['cella'][0] / self.header['mx']
+
+    #return images [start, stop) of a stack as a view of the memory-mapped data (no data is copied)
+    def get_images(self, start, stop):
+        return self.data[start:stop]
+
+    #set the data to be written. 2D images are written as a stack of one
+    def set_data(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim == 2:
+            data = data.reshape((1,) + data.shape)
+        assert data.ndim == 3, 'MRC data must be a 2D image, a stack of 2D images, or a 3D volume.'
+        self.data = data
+
+    #save the current data as 32-bit floats in a single write. If stack, write as a stack of 2D images (space group 0),
+    #otherwise as a 3D volume (space group 1)
+    def write_mrc(self, name, apix, stack=True):
+        data = np.ascontiguousarray(self.data, dtype='<f4')
+        nz, ny, nx = data.shape
+        mz = 1 if stack else nz
+
+        ints = np.zeros(256, dtype='<i4')
+        floats = ints.view('<f4')
+        ints[0:4] = nx, ny, nz, 2
+        ints[7:10] = nx, ny, mz
+        floats[10:13] = nx * apix, ny * apix, mz * apix
+        floats[13:16] = 90.0
+        ints[16:19] = 1, 2, 3
+        if data.size:
+            floats[19:22] = data.min(), data.max(), data.mean(dtype=np.float64)
+            floats[54] = data.std(dtype=np.float64)
+        ints[22] = 0 if stack else 1
+        ints[27] = 20140
+        header = bytearray(ints.tobytes())
+        header[208:212] = b'MAP '
+        header[212:216] = b'\x44\x44\x00\x00'
+
+        with open(name, 'wb') as f:
+            f.write(bytes(header))
+            data.tofile(f)
+        self.mrcfile = name
+        self.header = {'nx': nx, 'ny': ny, 'nz': nz, 'mode': 2, 'mx': nx, 'my': ny, 'mz': mz,
+                       'cella': (nx * apix, ny * apix, mz * apix), 'ispg': int(ints[22]), 'nsymbt': 0}
+
+    def __repr__(self):
+        return 'Mrcfile(%s)' % self.mrcfile
+
+    def __str__(self):
+        return 'Mrcfile object with filename: %s' % self.mrcfile
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
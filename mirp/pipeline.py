@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+pipeline.py provides the stages of pipelined voting, in which reading and decoding the next microtubules, voting on the
+current microtubules, and formatting and writing finished microtubules run at the same time. Background threads pass work
+through bounded queues, so memory use stays bounded, and each stage handles its work in order, so output is deterministic.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+import external_sort
+import starfileIO
+import threading
+import queue
+import sys
+
+#marks the end of the items in a queue
+_DONE = object()
+
+
+#yield the items of an iterable, which is run in a background thread up to maxsize items ahead. Exceptions in the background
+#thread are raised here
+def background(iterable, maxsize=2):
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                q.put((item, None))
+            q.put((_DONE, None))
+        except BaseException:
+            q.put((_DONE, sys.exc_info()[1]))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        #let the background thread finish if the items are not all used
+        stop.set()
+        while thread.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+#group a stream of microtubules (in sorted order) into lists of whole micrographs of at least size microtubules
+def micrograph_chunks(mts, size):
+    chunk = []
+    for mt in mts:
+        if len(chunk) >= size and mt['rlnMicrographName'][0] != chunk[-1]['rlnMicrographName'][0]:
+            yield chunk
+            chunk = []
+        chunk.append(mt)
+    if chunk:
+        yield chunk
+
+
+#write particles (dictionaries of lists) to one or more starfiles, with the other datablocks of star. The first particles
+#written to a file set its labels, and later particles are added to the end of it. With background set, particles are
+#formatted and written in a background thread, holding up to maxsize writes in a queue
+class StarWriter:
+
+    def __init__(self, star, background=False, maxsize=4):
+        self.star = star
+        self.names = []
+        self._files = {}
+        self._error = None
+        self._queue = queue.Queue(maxsize) if background else None
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._consume, daemon=True)
+            self._thread.start()
+
+    def write(self, name, particles):
+        if self._error is not None:
+            raise self._error
+        if name not in self.names:
+            self.names.append(name)
+        if self._queue is None:
+            self._write(name, particles)
+        else:
+            self._queue.put((name, particles))
+
+    def _write(self, name, particles):
+        if name not in self._files:
+            head = starfileIO.Starfile(name)
+            for key in self.star._datablocks:
+                head.add_datablock(key, self.star.get_datablock(key))
+            head.add_datablock('data_particles', OrderedDict((label, []) for label in particles))
+            f = open(name, 'w')
+            external_sort.write_head(f, head)
+            self._files[name] = (f, head)
+        external_sort.write_rows(self._files[name][0], zip(*particles.values()))
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except BaseException:
+                    self._error = sys.exc_info()[1]
+
+    #finish writing, and write the datablocks after the particles to each file
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_DONE)
+            self._thread.join()
+        for f, head in self._files.values():
+            if self._error is None:
+                external_sort.write_tail(f, head)
+            f.close()
+        self._files = {}
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -12,23 +12,54 @@ __version__ = '2.0'
 
 
 import microtubules
+import starfileIO
+import helper_fns
+import plotting
+import arguments
 import argparse
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', required=True, help='Starfile to plot microtubule euler angles and XY shifts from.')
 parser.add_argument('-o', required=False, help='Give file name, if saving a copy is desired.')
 parser.add_argument('-n', required=False, type=int, help='The number of microtubule to plot.')
+parser.add_argument('--micrograph', required=False, help='Only plot the microtubules in this micrograph (rlnMicrographName), read directly from the starfile through an on-disk tube index (built on first use, next to the starfile).')
+parser.add_argument('--tube', required=False, type=int, help='With --micrograph, only plot the microtubule with this rlnHelicalTubeID.')
+parser.add_argument('--summary', required=False, action='store_true', help='Plot a summary of all particles in a few figures, instead of one figure per microtubule.')
+arguments.add_plot_arguments(parser, '-o')
 args = parser.parse_args()
+assert args.tube is None or args.micrograph, 'A micrograph (--micrograph) is required to select a microtubule with --tube.'
+assert not (args.micrograph and args.summary), 'A summary (--summary) is of all microtubules, so can not be used with --micrograph.'
 
-mts = microtubules.Microtubules(args.i, '.')
-num_mts = mts.mt_tot
-if args.o:
+#plots are only shown interactively when not saving to file
+helper_fns.select_mpl_backend(interactive=not args.o)
+from matplotlib import pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+#selected microtubules are read through the tube index, without reading the whole starfile
+if args.micrograph:
+    star = starfileIO.Starfile(args.i)
+    tube_ids = [args.tube] if args.tube is not None else star.tube_ids(args.micrograph)
+    mts = [mt for mt in (star.get_tube(args.micrograph, tube_id) for tube_id in tube_ids) if mt]
+    assert mts, 'No microtubules found for micrograph %s in %s' % (args.micrograph, args.i)
+    num_mts = len(mts)
+else:
+    mts = microtubules.Microtubules(args.i, '.')
+    num_mts = mts.mt_tot
+compact = args.o and args.compact_plots and not args.summary
+if compact:
+    tube_pages = plotting.ContactSheets(args.o, args.compact_plots, args.plot_grid, args.plot_dpi, args.plot_max_mb)
+elif args.o:
     plot_pdf = PdfPages('%s.pdf' % args.o)        
 
 if args.n:
     num_mts = args.n       
+if args.summary:
+    num_mts = 0
+    for fig in plotting.dataset_summary(mts):
+        if args.o:
+            plot_pdf.savefig(fig)
+    if not args.o:
+        plt.show()
 
 for mt in mts[:num_mts]:
     psi = mt['rlnAnglePsi']
@@ -39,7 +70,12 @@ for mt in mts[:num_mts]:
     xax = [i for i in range(1, len(psi)+1)]
     yt = [i for i in range(-180, 180 + 1, 40) ]
 
-    fig = plt.figure()
+    if compact:
+        fig = tube_pages.new_figure()
+        if fig is None:
+            continue
+    else:
+        fig = plt.figure()
     pax = fig.add_subplot(1,4,1)
     pax.set_title('Psi')
     pax.plot(xax, psi, 'o')
@@ -73,13 +109,20 @@ for mt in mts[:num_mts]:
     sax.set_xticks = xax
     sax.set_xlabel('Particle Number')
 
-    plt.tight_layout()
-    if args.o:
+    if compact:
+        tube_pages.savefig(fig)
+    elif args.o:
+        plt.tight_layout()
         plot_pdf.savefig(fig)
     else:
+        plt.tight_layout()
         plt.show()
 
-if args.o:
+if compact:
+    tube_pages.close()
+    if tube_pages.skipped:
+        print('Plot size limit reached, %i microtubules were not plotted.' % tube_pages.skipped)
+elif args.o:
     plot_pdf.close()
 plt.close()
 
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+plotting.py provides dataset-level diagnostic plots of microtubule euler angles and X/Y shifts, which summarise all
+particles in a handful of figures rather than one figure per microtubule, and output for per-microtubule plots, either as
+one vector figure per microtubule or as compact rasterised contact sheets.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import helper_fns
+import os
+
+np = helper_fns.np
+plt = helper_fns.LazyModule('matplotlib.pyplot', setup=helper_fns.select_mpl_backend)
+colors = helper_fns.LazyModule('matplotlib.colors')
+backend_pdf = helper_fns.LazyModule('matplotlib.backends.backend_pdf', setup=helper_fns.select_mpl_backend)
+
+
+###### Dataset summary ######
+#compute the per-particle and per-microtubule data summarised by dataset_summary, in one vectorised pass over all particles
+def summary_data(mts):
+    offsets = mts.get_offsets()
+    data = {'position': helper_fns.segment_positions(offsets), 'length': np.diff(offsets)}
+    for label in ('rlnAnglePsi', 'rlnAngleTilt', 'rlnAngleRot', 'rlnOriginXAngst', 'rlnOriginYAngst'):
+        data[label] = mts.get_column(label).astype(np.float64)
+    #straight line fit of Rot against particle number for each microtubule (as in Microtubules._fit_eulerXY)
+    data['rot_slope'], _, data['rot_residual'] = helper_fns.segmented_linregress(data['position'], data['rlnAngleRot'], offsets)
+    return data
+
+#plot a 2D histogram of values against particle position along the microtubule, on a log colour scale
+def _hist_vs_position(ax, position, values, title, ylabel, yrange=None):
+    xbins = np.arange(0.5, min(position.max(), 200) + 1.5)
+    ybins = np.linspace(yrange[0], yrange[1], 91) if yrange else 90
+    counts, xedges, yedges = np.histogram2d(position, values, bins=(xbins, ybins))
+    mesh = ax.pcolormesh(xedges, yedges, counts.T, norm=colors.LogNorm(vmin=1), rasterized=True)
+    ax.set_title(title)
+    ax.set_xlabel('Particle Number')
+    ax.set_ylabel(ylabel)
+    return mesh
+
+#return a handful of figures summarising euler angles, X/Y shifts and per-microtubule Rot fits for all particles in mts
+def dataset_summary(mts):
+    data = summary_data(mts)
+    figs = []
+
+    fig = plt.figure(figsize=(15, 4.5))
+    for i, (label, title) in enumerate((('rlnAnglePsi', 'Psi'), ('rlnAngleTilt', 'Tilt'), ('rlnAngleRot', 'Rot'))):
+        ax = fig.add_subplot(1, 3, i+1)
+        mesh = _hist_vs_position(ax, data['position'], data[label], title, 'Angle', (-181, 181))
+        fig.colorbar(mesh, ax=ax, label='Particles')
+    fig.tight_layout()
+    figs.append(fig)
+
+    fig = plt.figure(figsize=(10, 4.5))
+    for i, (label, title) in enumerate((('rlnOriginXAngst', 'X shifts'), ('rlnOriginYAngst', 'Y shifts'))):
+        ax = fig.add_subplot(1, 2, i+1)
+        mesh = _hist_vs_position(ax, data['position'], data[label], title, 'Angstrom')
+        fig.colorbar(mesh, ax=ax, label='Particles')
+    fig.tight_layout()
+    figs.append(fig)
+
+    fitted = np.isfinite(data['rot_slope'])
+    fig = plt.figure(figsize=(15, 4.5))
+    ax = fig.add_subplot(1, 3, 1)
+    ax.hist(data['length'], bins=50)
+    ax.set_title('Microtubule length (%i microtubules)' % len(data['length']))
+    ax.set_xlabel('Particles')
+    ax.set_ylabel('Frequency')
+    ax = fig.add_subplot(1, 3, 2)
+    ax.hist(data['rot_slope'][fitted], bins=100, range=(-20, 20))
+    ax.set_title('Rot slope per microtubule')
+    ax.set_xlabel('Degrees per particle')
+    ax.set_ylabel('Frequency')
+    ax = fig.add_subplot(1, 3, 3)
+    ax.hist(data['rot_residual'][fitted], bins=100, range=(0, 180))
+    ax.set_title('Rot fit residual per microtubule')
+    ax.set_xlabel('RMS residual (o)')
+    ax.set_ylabel('Frequency')
+    fig.tight_layout()
+    figs.append(fig)
+
+    fig = plt.figure(figsize=(5.5, 4.5))
+    ax = fig.add_subplot(1, 1, 1)
+    counts, xedges, yedges = np.histogram2d(data['rot_slope'][fitted], data['rot_residual'][fitted], bins=(80, 60), range=((-20, 20), (0, 180)))
+    mesh = ax.pcolormesh(xedges, yedges, counts.T, norm=colors.LogNorm(vmin=1), rasterized=True)
+    fig.colorbar(mesh, ax=ax, label='Microtubules')
+    ax.set_title('Rot slope against fit residual')
+    ax.set_xlabel('Degrees per particle')
+    ax.set_ylabel('RMS residual (o)')
+    fig.tight_layout()
+    figs.append(fig)
+    return figs
+
+
+###### Per-microtubule plots ######
+#one vector figure per microtubule, saved as the pages of a PDF. Per-microtubule plotting functions draw on a figure
+#from new_figure, and pass it back to savefig when finished
+class TubePages:
+
+    def __init__(self, name):
+        self.name = '%s.pdf' % name
+        self.skipped = 0
+        self._pdf = backend_pdf.PdfPages(self.name)
+
+    def new_figure(self):
+        return plt.figure()
+
+    def savefig(self, fig):
+        fig.tight_layout()
+        self._pdf.savefig(fig)
+        plt.close(fig)
+
+    def close(self):
+        self._pdf.close()
+
+
+#compact rasterised per-microtubule plots. The figure for each microtubule is drawn as one tile of a grid x grid contact
+#sheet, and each sheet is saved as a PNG image (name_0001.png, ...) or as a rasterised page of a PDF (name.pdf).
+#once the output reaches max_mb, no more sheets are written, and further microtubules are counted in skipped
+class ContactSheets:
+
+    def __init__(self, name, fmt='png', grid=6, dpi=60, max_mb=None):
+        assert fmt in ('png', 'pdf'), 'Contact sheets must be png or pdf.'
+        self.name = name
+        self.fmt = fmt
+        self.grid = grid
+        self.dpi = dpi
+        self.max_bytes = max_mb * 1024**2 if max_mb else None
+        self.skipped = 0
+        self.pages = 0
+        self.written = 0
+        self._pdf = backend_pdf.PdfPages('%s.pdf' % name) if fmt == 'pdf' else None
+        self._page = None
+        self._tiles = []
+        self._used = []
+
+    #return the tile for the next microtubule (a matplotlib SubFigure, used like a Figure), or None if over the size limit
+    def new_figure(self):
+        if self.max_bytes is not None and self.written >= self.max_bytes:
+            self.skipped += 1
+            return None
+        if not self._tiles:
+            self._page = plt.figure(figsize=(4.8 * self.grid, 3.0 * self.grid), dpi=self.dpi)
+            self._tiles = list(self._page.subfigures(self.grid, self.grid).flat)
+            self._used = []
+        tile = self._tiles.pop(0)
+        self._used.append(tile)
+        return tile
+
+    def savefig(self, fig):
+        fig.subplots_adjust(left=0.16, right=0.97, bottom=0.18, top=0.88, wspace=0.6)
+        if not self._tiles:
+            self._save_page()
+
+    def _save_page(self):
+        if self._page is None:
+            return
+        self.pages += 1
+        if self.fmt == 'png':
+            name = '%s_%04i.png' % (self.name, self.pages)
+            self._page.savefig(name, dpi=self.dpi)
+            self.written += os.path.getsize(name)
+        else:
+            for tile in self._used:
+                for ax in tile.axes:
+                    ax.set_rasterized(True)
+            self._pdf.savefig(self._page, dpi=self.dpi)
+            self.written = os.path.getsize('%s.pdf' % self.name)
+        plt.close(self._page)
+        self._page = None
+        self._tiles = []
+
+    def close(self):
+        self._save_page()
+        if self._pdf is not None:
+            self._pdf.close()
+
+
+#no per-microtubule plots, e.g. when following a running job, where plotting every iteration would be slow
+class NoPages:
+
+    def __init__(self, name):
+        self.name = name
+        self.skipped = 0
+
+    def new_figure(self):
+        return None
+
+    def savefig(self, fig):
+        pass
+
+    def close(self):
+        pass
+
+
+#return the per-microtubule plot output for a name (without extension). options are the keyword arguments of ContactSheets,
+#or None for one vector figure per microtubule. Format None turns per-microtubule plots off
+def tube_pages(name, options=None):
+    if options is None:
+        return TubePages(name)
+    if options['fmt'] is None:
+        return NoPages(name)
+    return ContactSheets(name, **options)
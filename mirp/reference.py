@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+reference.py is a frozen copy of the original per-microtubule, pure Python voting of MiRP v2, kept as the reference that
+the faster voting in microtubules.py is checked against (see check_equivalence.py). It is not changed when microtubules.py
+changes, since any difference between the two is what the check reports. The original starfile reader and writer, and the
+grouping, sorting and splitting helpers, are copied here unchanged, so that changes to starfileIO.py and helper_fns.py do not
+change the reference either (e.g. splitting with np.split still gives float values to a column mixing integers and floats).
+Plotting and progress output are left out.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+from scipy import stats
+import numpy as np
+import collections
+import itertools
+import operator
+import math
+import ast
+
+
+###### I/O ######
+#read a starfile, and split its particles into microtubules (list of dictionaries of lists), sorted by micrograph, tube ID and
+#track length. Returns the starfile and the microtubules
+def read_microtubules(starfile):
+    star = Starfile(starfile)
+    star.read_star()
+    if not star.get_loopdatablock_len('data_particles'):
+        return star, []
+    star.sort_loop_datablock('data_particles', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
+    return star, group_dict_of_list(star.get_datablock('data_particles'), 'rlnMicrographName', 'rlnHelicalTubeID')
+
+#write microtubules to a starfile, with the other datablocks of star
+def write_microtubules(star, mts, name):
+    out = Starfile(name)
+    for key in star._datablocks:
+        out.add_datablock(key, star.get_datablock(key))
+    if mts:
+        out.add_datablock('data_particles', microtubules_to_particles(mts))
+    else:
+        out.add_datablock('data_particles', OrderedDict((label, []) for label in star.get_labels('data_particles')))
+    out.write_star(name)
+
+#convert from list of dictionaries (microtubules) to particles (dictionary of lists)
+def microtubules_to_particles(mts):
+    data = {k:[] for k in mts[0].keys()}
+    for mt in mts:
+        for key in mt.keys():
+            data[key] += list(mt[key])
+    return data
+
+#return the number of particles in a given microtubule
+def microtubule_len(microtubule):
+    return len(microtubule['rlnHelicalTubeID'])
+
+
+
+###### Votes ######
+#vote on protofilament number. Returns the corrected microtubules (split where the smoothened class number changes, with
+#every class number replaced by the modal class, and renumbered), and the confidence of each microtubule long enough to vote on
+def vote_pf_number(mts, cutoff):
+    cutoff = float(cutoff)
+    split_mts = []
+    confidence_data = []
+    for microtubule in mts:
+        #smoothen class numbers by taking the mode for each particle over a seven particle window, and split the microtubule
+        #where the smoothened class number changes
+        smoothened_data = mode_smoothen(microtubule['rlnClassNumber'])
+        for mt in split_mt_on_change(microtubule, smoothened_data):
+            confidence = vote_mode(mt, 'rlnClassNumber')
+            #remove very short microtubules
+            if microtubule_len(mt) < 5:
+                pass
+            #remove microtubules with a low confidence in class assignment
+            elif confidence < cutoff:
+                confidence_data.append(confidence)
+            else:
+                confidence_data.append(confidence)
+                split_mts.append(renumber_tube_id(split_mts, mt))
+    return split_mts, confidence_data
+
+#vote on Rot angle, and correct Psi flips. Returns the corrected microtubules, and the confidence of each
+def vote_on_rot(mts):
+    cutoff = 8
+    corrected_mts = []
+    confidence = []
+    for microtubule in mts:
+        rot_angles = microtubule['rlnAngleRot']
+        modal_clust, outliers = cluster_shallow_slopes(rot_angles, cutoff)
+        #remove any microtubules for which clusters cannot be found
+        if not modal_clust:
+            continue
+        confidence.append(len(modal_clust) / microtubule_len(microtubule) * 100)
+        fit = fit_eulerXY(rot_angles, modal_clust)
+        microtubule['rlnAngleRot'] = fit
+        microtubule['rlnAngleRotPrior'] = fit
+        psi_angles = microtubule['rlnAnglePsi']
+        modal_clust, _ = cluster_shallow_slopes(psi_angles, cutoff)
+        fit = fit_eulerXY(psi_angles, modal_clust)
+        microtubule['rlnAnglePsi'] = fit
+        microtubule['rlnAnglePsiPrior'] = fit
+        corrected_mts.append(microtubule)
+    return corrected_mts, confidence
+
+#vote on X/Y shifts. Returns the corrected microtubules
+def vote_on_xy(mts, cutoff):
+    for microtubule in mts:
+        try:
+            del microtubule['rlnAnglePsiFlipRatio']
+        except KeyError:
+            pass
+        Xsh, Ysh = microtubule['rlnOriginXAngst'], microtubule['rlnOriginYAngst']
+        #find most populated linear region (modal cluster)
+        Xmodal_clust = max(cluster_breaks(Xsh, cutoff), key = len)
+        Ymodal_clust = max(cluster_breaks(Ysh, cutoff), key = len)
+        if Xmodal_clust == [0]:
+            Xcorr = [0 for x in range(1, len(Xsh)+1)]
+            Ycorr = [0 for x in range(1, len(Ysh)+1)]
+        else:
+            Xcorr = fit_eulerXY(Xsh, Xmodal_clust)
+            Ycorr = fit_eulerXY(Ysh, Ymodal_clust)
+        microtubule['rlnOriginXAngst'] = Xcorr
+        microtubule['rlnOriginYAngst'] = Ycorr
+    return mts
+
+#vote on relative seam position. Returns the corrected microtubules, and the confidence of each
+def vote_on_seam(mts, cutoff, pfnum, rise):
+    cutoff = float(cutoff)
+    pfnum = int(pfnum)
+    rise = float(rise)
+    confidence_data = []
+    new_mts = []
+    for microtubule in mts:
+        mt_len = microtubule_len(microtubule)
+        #get modal class for this microtubule, and confidence in class assignment
+        top_class, top_class_freq = collections.Counter(microtubule['rlnClassNumber']).most_common(1)[0]
+        confidence = top_class_freq / mt_len * 100
+        confidence_data.append(confidence)
+        #remove microtubules with lower confidence than the cutoff
+        if confidence < cutoff:
+            continue
+        #correct microtubules with alpha/beta-tubulin out of register
+        if top_class > pfnum:
+            shift_along_z(microtubule, 41)
+            microtubule['rlnClassNumber'] = [top_class - pfnum for _ in range(mt_len)]
+        else:
+            microtubule['rlnClassNumber'] = [top_class for _ in range(mt_len)]
+        correct_pfregister(pfnum, rise, microtubule)
+        new_mts.append(microtubule)
+    return new_mts, confidence_data
+
+
+
+###### Methods for microtubule angle, shift, and class correction ######
+#for a list of numbers (e.g. class assignment for a microtubule), smoothen the numbers by calculating the mode over a window of 7.
+#ties go to the smallest value (as scipy.stats.mode)
+def mode_smoothen(data):
+    smoothened = []
+    for i, _ in enumerate(data):
+        l, h = get_window(i, 3, 4, len(data))
+        smoothened.append(int(stats.mode(data[l:h])[0]))
+    return smoothened
+
+#for data from a microtubule, split the microtubule where changes in data value occur
+def split_mt_on_change(microtubule, data):
+    changes = []
+    for index, (curr, nxt) in enumerate( zip(data[:-1], data[1:]) ):
+        if curr - nxt != 0:
+            changes.append(index+1)
+    return split_dict_of_list(microtubule, changes)
+
+#find the modal value for a data entry in a microtubule, and change all values in the data entry to this. Return the confidence
+#in the mode. Ties go to the value that occurs first (as collections.Counter)
+def vote_mode(microtubule, label):
+    mt_len = microtubule_len(microtubule)
+    mode, freq = collections.Counter(microtubule[label]).most_common(1)[0]
+    microtubule[label] = [mode for _ in range(mt_len)]
+    return freq / mt_len * 100
+
+#renumber a microtubule split from a larger one, following on from the last microtubule kept (mts) if in the same micrograph
+def renumber_tube_id(mts, mt):
+    try:
+        prev_mgph = mts[-1]['rlnMicrographName'][0]
+        curr_mgph = mt['rlnMicrographName'][0]
+        if curr_mgph == prev_mgph:
+            curr_tubeid = int(mts[-1]['rlnHelicalTubeID'][0]) + 1
+        else:
+            curr_tubeid = 1
+    except IndexError:
+        curr_tubeid = 1
+    mt['rlnHelicalTubeID'] = [curr_tubeid for _ in range(microtubule_len(mt))]
+    return mt
+
+#for a list of y-values, extract the desired values stated in xax_data_tofit, and perform linear regression on them. Fit and
+#return all values to this equation
+def fit_eulerXY(ydata, xax_data_tofit):
+    yax_data_tofit = [ydata[x] for x in xax_data_tofit]
+    slope, yincept = stats.linregress(xax_data_tofit, yax_data_tofit)[0:2]
+    return [yincept + x*slope for x in range(1, len(ydata)+1)]
+
+#finds clusters where 2D data follows many straight lines with shallow slopes (e.g. microtubule Rot angles).
+#returns the largest cluster (the first found, on ties), and the other clusters
+def cluster_shallow_slopes(angles, cutoff):
+    #index of all datapoint pairs that are within the cutoff
+    linkMtrx = [ (i, i2) for ( (i, j), (i2, j2) )
+                in itertools.combinations( enumerate(angles), 2 )
+                if -cutoff <= float(j) - float(j2) <= cutoff]
+
+    #creates non-redundant set of clusters of related datapoints
+    cluster = []
+    while linkMtrx:
+        node = linkMtrx[-1]
+        for idx, pair in reversed( list( enumerate(linkMtrx[:-1]) ) ):
+            if any( i == j for i, j in itertools.combinations(node+pair, 2) ):
+                node += pair
+                node = tuple( set(node) )
+                del linkMtrx[idx]
+        del linkMtrx[-1]
+        cluster.append( sorted(node) )
+
+    if not cluster:
+        return None, None
+    topclst = cluster.pop( max( enumerate( [len(i) for i in cluster] ),
+                                key=operator.itemgetter(1) )[0])
+    return topclst, cluster
+
+#find the linear regions in 2D data, with boundaries where the residual between neighbours is outside the cutoff
+def cluster_breaks(data, cutoff):
+    diff = [curr - nxt for curr, nxt in zip(data[:-1], data[1:])]
+    clusters = []
+    clust = [0]
+    for index, d in enumerate(diff):
+        if -cutoff <= d <= cutoff:
+            clust.append(index + 1)
+        else:
+            clusters.append(clust)
+            clust = [index + 1]
+    clusters.append(clust)
+    return clusters
+
+#use the seam class to calculate the seam position relative to the 3D reference, and correct the Rot angle and X/Y shifts
+def correct_pfregister(pfnum, rise, mt):
+    seampos = convert_pfnum_to_semicircle(mt['rlnClassNumber'][0], pfnum)
+    twist = (360 / pfnum)
+    Drot = seampos * twist
+    for i in range(microtubule_len(mt)):
+        rot = mt['rlnAngleRot'][i]
+        mt['rlnAngleRot'][i] = rot + Drot
+        try:
+            mt['rlnAngleRotPrior'][i] = rot + Drot
+        except KeyError:
+            pass
+    shift_along_z(mt, seampos*rise)
+
+#translate particles along the microtubule z-axis using psi angle and desired z-axis translation (hypotenuse) to edit the x/y shifts
+def shift_along_z(mt, shift):
+    for i in range(microtubule_len(mt)):
+        psi = mt['rlnAnglePsi'][i]
+        xsh = mt['rlnOriginXAngst'][i]
+        ysh = mt['rlnOriginYAngst'][i]
+        dx = shift * math.cos(-psi * math.pi / 180)
+        dy = shift * math.sin(-psi * math.pi / 180)
+        mt['rlnOriginXAngst'][i] = xsh + dx
+        mt['rlnOriginYAngst'][i] = ysh + dy
+
+#for the current protofilament number (e.g. a number between 1 and 14), return a symmetry operator between e.g. -6 and 7
+def convert_pfnum_to_semicircle(current_pfnumber, total_pfnumber):
+    half_circle = math.ceil( float(total_pfnumber) / 2 )
+    if current_pfnumber <= half_circle:
+        return current_pfnumber - 1
+    else:
+        return -(total_pfnumber % current_pfnumber) - 1
+
+
+
+###### Original starfile reader and writer (starfileIO.py of MiRP v2) ######
+#calls to helper_fns are to the copies of its functions below
+class Starfile:
+    
+    def __init__(self, starfile):
+        self.starfile = starfile
+        self._datablocks = OrderedDict()
+
+    def read_star(self):
+        loop = False 
+                        
+        for fields in readfile(self.starfile):
+            
+            #identify if at start of new datablock
+            if fields[0].startswith('data_'):
+                curr_datablock_id = fields[0]
+                curr_datablock = OrderedDict()
+                self._datablocks[curr_datablock_id] = curr_datablock
+                loop = False
+            
+            #identify if in loop style datablock
+            elif fields[0] == 'loop_':
+                loop = True
+        
+            #identify if encountered a data label
+            elif fields[0].startswith('_'):
+                label = fields[0][1:]
+                #if loop data, make dictionary of datalabels as keys
+                if loop:
+                    curr_datablock[label] = []
+                #if key-val data, make dictionary of key-val data
+                else:
+                    data = literal_eval(fields[1])
+                    curr_datablock[label] = data
+
+            #if loop data and not encountered a data label, populate data label dictionary with data    
+            elif loop:
+                labels = curr_datablock.keys()
+                assert len(labels) == len(fields), ('Error: Some data in starfile %s does not match the labels!\n%s\n%s\n' % (self.starfile, labels, data))
+                for label, data in zip(labels, fields):
+                    data = literal_eval(data)
+                    curr_datablock[label].append(data)
+            else:
+                print('Error: could not understand this line in starfile %s:\n%s\n' % (self.starfile, fields))
+
+
+    ###### Getting starfile data ######
+    #return the data of a specified datablock
+    def get_datablock(self, datablock_id):
+        return self._datablocks[datablock_id]
+    
+    #return the data labels only from a specified datablock
+    def get_labels(self, datablock_id):
+        return self._datablocks[datablock_id].keys()
+    
+    #return the data values only from a specified datablock
+    def get_data(self, datablock_id):
+        return self._datablocks[datablock_id].keys()
+    
+    #return the data from a specified datablock, associated with a specified data label
+    def get_entry(self, datablock_id, label):
+        return self._datablocks[datablock_id][label]
+    
+    #return the number of data entries in loop type datablock
+    def get_loopdatablock_len(self, datablock_id):
+        key = list(self._datablocks[datablock_id].keys())[0]
+        return len(self._datablocks[datablock_id][key])
+    
+
+    ###### Updating/adding starfile data ######
+    # data must be in dictionary format, where the key is the starfile data label, and the value is the starfile data
+    #add a new datablock to an empty or existing starfile
+    def add_datablock(self, datablock_id, datablock):
+        assert isinstance(datablock, dict), 'Datablock must be a dictionary!'
+        self._datablocks[datablock_id] = datablock
+        
+    #append loop data to an existing loop type datablock.     
+    def add_loop_data(self, datablock_id, data):
+        assert isinstance(data, dict), 'Data must be a dictionary!'
+        
+        db = self._datablocks[datablock_id]
+        assert len(data) == len(db), 'New loop data must have the same number of labels as in the current datablock.'
+        for key in (data):
+            assert key in db, 'New loop data must have the same labels as in the current datablock.'
+            
+        for key in data:
+            val = data[key]
+            if isinstance(val, list):
+                db[key] += val
+            else:
+                db[key].append(val)
+                
+    #add data to existing key-val type datablock.
+    def add_nonloop_data(self, datablock_id, data):
+        assert isinstance(data, dict), 'Data must be a dictionary!'
+        
+        db = self._datablocks[datablock_id]
+        for key in data:
+            assert key not in db, 'New non-loop data cannot have a label that is already in the datablock. Use update_nonloop_data instead.'
+            assert not isinstance (data[key], list), 'Non-loop data cannot be a list.'
+            
+        for key in data:
+            val = data[key]
+            db[key] = val
+    
+    #replace loop data from a specified datablock, at a specified index
+    def update_loop_data(self, datablock_id, data, index):
+        assert isinstance(data, dict), 'Data must be a dictionary!'
+        
+        db = self._datablocks[datablock_id]
+        assert len(data) == len(db), 'New loop data must have the same number of labels as in the current datablock'
+        for key in (data):
+            assert key in db, 'New loop data must have the same labels as in the current datablock.'
+            assert not isinstance (data[key], list), 'New loop data to update with cannot be a list.'
+    
+        for key in data:
+            db[key][index] = data[key]
+            
+    #replace an existing entry in a key-val type datablock   
+    def update_nonloop_data(self, datablock_id, data):
+        assert isinstance(data, dict), 'Data must be a dictionary!'
+        
+        db = self._datablocks[datablock_id]
+        for key in data:
+            assert key in db, 'New non-loop data to update with must have an existing label in the datablock. Use add_nonloop_data instead.'
+            assert not isinstance (data[key], list), 'Non-loop data cannot be a list.'
+            
+        for key in data:
+            db[key] = data[key]
+        
+    #order the data in a loop type datablock based on one or more data
+    def sort_loop_datablock(self, datablock_id, *labels):
+        data = self.get_datablock(datablock_id)
+        data = sort_dict_of_list(data, *labels)
+        self.add_datablock(datablock_id, data)
+
+    # save the current starfile data 
+    def write_star(self, name):
+         
+        with open(name, 'w') as f:
+        
+            for key in self._datablocks:
+                f.write('\n%s\n\n' % key)
+                datablock = self._datablocks[key]
+                
+                labels = datablock.keys()
+                data = list(datablock.values())
+                if isinstance(data[0], list) or isinstance(data[0], tuple):
+                    f.write('loop_\n')
+                    for idx, label in enumerate(labels):
+                        f.write('_%s\t#%i\n' % (label, idx+1))
+                    for entry in zip(*data):
+                        f.write('\t'.join(str(val) for val in entry) + '\n')
+                else:
+                    for label, entry in zip(labels, data):
+                        f.write('_%s\t%s\n' % (label, str(entry)))
+
+
+    def __repr__(self):
+        return 'Starfile(%s)' % self.starfile
+    
+    def __str__(self):
+        return 'Starfile object with filename: %s' % self.starfile
+    
+    def __setitem__(self, key, value):
+        self._datablocks[key] = value
+
+    def __getitem__(self, key):
+        return self._datablocks[key]
+
+
+
+
+###### Original helpers (py of MiRP v2) ######
+def get_window(index, lw, hi, size):
+    lwin, hwin = index - lw, index + hi
+    if lwin < 0 :
+        lwin = 0
+    if hwin > size:
+        hwin = size
+    return lwin, hwin
+
+
+def group_dict_of_list(dict, *labels):
+    keys = dict.keys()
+    data = zip(*dict.values())
+    grouped = []
+    labels = [index_from_odict(dict, lbl) for lbl in labels]
+    for _, grp in groupby(data, itemgetter(*labels)):
+        group = OrderedDict()
+        for k, v in zip(keys, zip(*grp)):
+            group[k] = list(v)
+        grouped.append(group)
+    return grouped
+
+
+def sort_dict_of_list(dict, *keys):
+    data = trnsp_dict_of_lst(dict)
+    data = sorted(data, key=itemgetter(*keys))
+    return trnsp_lst_of_dict(data)
+
+
+def split_dict_of_list(dict, indices):
+    split = []
+    split_vals = zip(*[np.split(val, indices) for val in dict.values()])
+    for frac in split_vals:
+        new = OrderedDict()
+        for key, val in zip(dict.keys(), frac):
+            new[key] = val
+        split.append(new)
+    return split
+
+
+def index_from_odict(dict, key):
+    for i, k in enumerate(dict.keys()):
+        if k == key:
+            return i
+    
+
+def trnsp_lst_of_dict(lod):
+    dol = OrderedDict()
+    for k in lod[0].keys():
+        dol[k] = []
+    for odict in lod:
+        for key in odict:
+            dol[key].append(odict[key])
+    return dol
+
+
+def trnsp_dict_of_lst(dict_of_list):
+    return [OrderedDict(zip(dict_of_list, col))
+            for col in zip(*dict_of_list.values())]
+
+
+def literal_eval(var):
+    try: var = ast.literal_eval(var)
+    except: var = str(var)
+    return var
+
+
+def readfile(filepath):
+    with open(filepath, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                pass
+            elif fields[0].startswith('#'):
+                pass
+            else:
+                yield fields
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+reference_cache.py provides a content-addressed on-disk cache of generated seam reference sets. Sets are keyed by a hash
+of the input volume, the parameters used to generate them and the cache version, and the least recently used sets are
+evicted when the cache grows beyond a maximum total size.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import hashlib
+import shutil
+import fcntl
+import os
+
+#file written last into a cache entry, so that incomplete entries are never used
+COMPLETE = 'seam_references.star'
+#part of every cache key. Increase it when the references generated for the same volume and parameters change (e.g. a change
+#to seam_references), so that sets made by older versions are not used
+CACHE_VERSION = 1
+#Linux ioctl that makes a copy-on-write clone (reflink) of a file
+FICLONE = 0x40049409
+
+
+#default cache location, which can be set with the MIRP_CACHE environment variable
+def default_cache_dir():
+    root = os.environ.get('MIRP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'mirp'))
+    return os.path.join(root, 'seam_references')
+
+#hash the contents of a file together with any generation parameters and the cache version
+def cache_key(filename, *params):
+    sha = hashlib.sha256(b'%i\n' % CACHE_VERSION)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    sha.update(repr(params).encode())
+    return sha.hexdigest()
+
+#return the cache entry folder for a key, or None if it has not been cached. Marks the entry as recently used
+def lookup(cache_dir, key):
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, COMPLETE)):
+        return None
+    os.utime(entry)
+    return entry
+
+#copy a file, as a reflink where the filesystem supports them (e.g. Btrfs or XFS), so that the copy takes no extra space until
+#either file is changed. Files are never hard linked, since changing an output would then change the cached set
+def copy_file(src, dst):
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+
+#add copies of files to the cache under a key. The star file is written by write_star(path) into the entry last, marking it
+#complete. Cached files are read-only. Entries are assembled in a temporary folder and renamed into place, so concurrent jobs
+#never see a partial entry
+def store(cache_dir, key, files, write_star):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(entry):
+        return entry
+    tmp = os.path.join(cache_dir, '.%s.%i.tmp' % (key, os.getpid()))
+    os.mkdir(tmp)
+    for f in files:
+        copy_file(f, os.path.join(tmp, os.path.basename(f)))
+        os.chmod(os.path.join(tmp, os.path.basename(f)), 0o444)
+    write_star(os.path.join(tmp, COMPLETE))
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        #another job stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return entry
+
+#total size in bytes of all files in a folder
+def _folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+#remove the least recently used entries until the cache is no larger than max_bytes. The entry being used (keep) is never removed
+def evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith('.'):
+            entries.append((os.path.getmtime(path), _folder_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.samefile(path, keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    return total
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+seam_references.py provides NumPy functions for generating seam references for 3D seam classification from a single
+3D reference, as used by generate_seam_references.py.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import helper_fns
+import microtubules
+import segment_averages
+import mrcIO
+
+np = helper_fns.np
+fft = helper_fns.LazyModule('scipy.fft')
+
+#input volumes already read by this process, so that each worker process reads the reference once
+_volumes = {}
+
+
+#make the seam reference for one relative seam position, and the same reference translated by a further shift along z
+#(for testing alpha/beta-tubulin register). job is (reference mrc, output folder, pf, total pf, rise, pixel size, shift),
+#with the rise and shift in angstrom. Returns the names of the two volumes written
+def seam_reference(job):
+    ref, outdir, pf, pftotal, rise, apix, shift = job
+    if ref not in _volumes:
+        volume = mrcIO.Mrcfile(ref)
+        _volumes[ref] = np.array(volume.read_mrc(), dtype=np.float64)
+    volume = _volumes[ref]
+
+    #get +/- symmetry operators, and the change in angle and z-axis translation for that seam position
+    seampos = microtubules.convert_pfnum_to_semicircle(pf, pftotal)
+    Drot = seampos * -360.0 / float(pftotal)
+    Dz = seampos * -rise / apix
+
+    #rotate about z by rotating every z-slice in-plane, following the EMAN2 'eman' az convention
+    nz = len(volume)
+    rotated = segment_averages.transform_stack(volume, np.full(nz, Drot), np.zeros(nz), np.zeros(nz))
+    outfiles = []
+    for name, tz in (('seamref%i.mrc' % seampos, Dz), ('seamref%i_%ishift.mrc' % (seampos, shift), Dz + shift / apix)):
+        out = mrcIO.Mrcfile('%s/%s' % (outdir, name))
+        out.set_data(shift_along_z(rotated, tz))
+        out.write_mrc(out.mrcfile, apix, stack=False)
+        outfiles.append(out.mrcfile)
+    return outfiles
+
+#translate a (nz, ny, nx) volume along z by tz pixels, by multiplying its Fourier transform with a phase ramp
+def shift_along_z(volume, tz):
+    if not tz:
+        return volume
+    nz = len(volume)
+    kz = np.fft.rfftfreq(nz).reshape(-1, 1, 1)
+    ft = fft.rfft(volume, axis=0)
+    ft *= np.exp(-2j * np.pi * kz * tz)
+    return fft.irfft(ft, n=nz, axis=0)
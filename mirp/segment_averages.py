@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+segment_averages.py provides NumPy functions for aligning microtubule particle stacks and averaging them
+over sliding windows of neighbouring particles, as used by generate_segment_averages.py.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import helper_fns
+import mrcIO
+import re
+
+np = helper_fns.np
+fft = helper_fns.LazyModule('scipy.fft')
+
+
+###### Sliding window averaging ######
+#number of particles before and after (inclusive of) the current particle for a window of a given size, e.g. 7 -> (3, 4)
+def window_extent(size):
+    assert size >= 1, 'Segment average window size must be at least 1.'
+    lw = (size - 1) // 2
+    return lw, size - lw
+
+#average each image in a (N, box, box) stack over sliding windows of its neighbours along the microtubule, for each of a list
+#of window sizes. A prefix sum over the stack is taken once, and every window of every size is the difference of two partial
+#sums, rather than re-adding every image in the window. Windows are truncated at the ends of the microtubule, as in
+#helper_fns.get_window. Returns one averaged stack per size
+def window_averages(stack, sizes):
+    n = len(stack)
+    #accumulate in double precision, so that subtracting large partial sums does not lose precision
+    csum = np.zeros((n + 1,) + stack.shape[1:], dtype=np.float64)
+    np.cumsum(stack, axis=0, out=csum[1:])
+    index = np.arange(n)
+    averages = []
+    for size in sizes:
+        lw, hi = window_extent(size)
+        low = np.clip(index - lw, 0, n)
+        high = np.clip(index + hi, 0, n)
+        average = csum[high] - csum[low]
+        average /= (high - low).reshape((n,) + (1,) * (stack.ndim - 1))
+        averages.append(average.astype(stack.dtype, copy=False))
+    return averages
+
+#average each image in a stack over a sliding window of one size (see window_averages)
+def window_average(stack, size):
+    return window_averages(stack, [size])[0]
+
+
+###### Per-micrograph processing ######
+#generate segment averages for all microtubules of one micrograph, and write them to one stack per window size.
+#job is (outfiles, apix, windows, float32, tubes), with one output stack in outfiles for each window size in windows, and
+#where each tube is (particle stack, first image index, last image index + 1, psi, xsh, ysh). Each microtubule is read and
+#aligned once for all window sizes. Returns the output stack names and the number of segment averages in each
+def average_micrograph(job):
+    outfiles, apix, windows, float32, tubes = job
+    stack = None
+    averages = [[] for _ in windows]
+    for particle_stack, start, stop, psi, xsh, ysh in tubes:
+        #memory-map each particle stack once, and take each microtubule's particles as a slice of it
+        if stack is None or stack.mrcfile != particle_stack:
+            stack = mrcIO.Mrcfile(particle_stack)
+            stack.read_mrc()
+        #2D transform particles prior to averaging, average along sliding windows, then transform back to original position
+        aligned = transform_stack(stack.get_images(start, stop), psi, xsh, ysh, float32)
+        for window_stacks, averaged in zip(averages, window_averages(aligned, windows)):
+            window_stacks.append(transform_stack(averaged, -psi, -xsh, -ysh, float32))
+    for outfile, window_stacks in zip(outfiles, averages):
+        out = mrcIO.Mrcfile(outfile)
+        out.set_data(np.concatenate(window_stacks))
+        out.write_mrc(outfile, apix)
+    return outfiles, len(out)
+
+
+#generate the rlnImageName of the segment average of every particle (NNNNNN@outdir/Micrographs/<stack>_SAs.mrcs), from the
+#particle names (rlnImageName) in the sorted particle order of mts. Particles are numbered from 1 within each micrograph, the
+#order they are written by average_micrograph
+def segment_average_names(mts, outdir, names):
+    offsets = mts.get_offsets()
+    #micrograph of each microtubule from the existing grouping, expanded to a micrograph code for each particle
+    mgph_codes, mgph_starts = helper_fns.run_codes([mt['rlnMicrographName'][0] for mt in mts])
+    codes = np.repeat(mgph_codes, np.diff(offsets))
+    numbers = np.arange(offsets[-1]) - offsets[mgph_starts][codes] + 1
+    numbers = np.char.zfill(numbers.astype(str), 6)
+
+    #output stack name for each distinct input stack, looked up for each particle by its stack code
+    names = np.asarray(names)
+    stacks, stack_codes = np.unique(np.char.partition(names, '@')[:, 2], return_inverse=True)
+    name_regex = re.compile(r'.+/(.+\.mrcs)')
+    outnames = np.array(['@%s/Micrographs/%s' % (outdir, re.search(name_regex, stack).group(1).replace('.mrcs', '_SAs.mrcs')) for stack in stacks])
+    return np.char.add(numbers, outnames[stack_codes]).tolist()
+
+
+#rlnImageName of the segment averages of one microtubule, whose first particle is number first in the segment average stack
+#of its micrograph, as segment_average_names, for microtubules that are streamed one at a time
+def tube_segment_average_names(names, first, outdir):
+    name_regex = re.compile(r'.+/(.+\.mrcs)')
+    outnames = []
+    for number, name in enumerate(names, first):
+        stack = re.search(name_regex, name.partition('@')[2]).group(1)
+        outnames.append('%06i@%s/Micrographs/%s' % (number, outdir, stack.replace('.mrcs', '_SAs.mrcs')))
+    return outnames
+
+
+###### Particle alignment ######
+#return per-particle in-plane rotation (degrees) and X/Y shifts (pixels) for a microtubule.
+#falls back to the Psi prior if Psi has not been refined, and to zero shifts if there are no origin offsets
+def get_alignment(microtubule, apix):
+    try:
+        psi = microtubule['rlnAnglePsi']
+    except KeyError:
+        psi = microtubule['rlnAnglePsiPrior']
+    psi = np.asarray(psi, dtype=np.float64)
+    try:
+        xsh = np.asarray(microtubule['rlnOriginXAngst'], dtype=np.float64) / apix
+        ysh = np.asarray(microtubule['rlnOriginYAngst'], dtype=np.float64) / apix
+    except KeyError:
+        xsh, ysh = np.zeros(len(psi)), np.zeros(len(psi))
+    return psi, xsh, ysh
+
+#number of pixels transformed together. The stack is processed in chunks of about this size, so that the intermediate
+#arrays of each chunk stay in cache
+CHUNK_PIXELS = 2**16
+
+#apply per-particle in-plane rotation (alpha, degrees) about the image centre, followed by a sub-pixel translation
+#(tx/ty, pixels), to a whole (N, box, box) stack at once. This follows the EMAN2 '2d' Transform convention, where
+#image content at x moves to Rx + t. Rotation uses bilinear interpolation, and translation is an exact phase shift
+#in Fourier space (so content shifted past one edge wraps around to the other). If float32, all intermediate arrays
+#are single precision, halving memory use
+def transform_stack(stack, alpha, tx, ty, float32=False):
+    dtype = np.float32 if float32 else np.float64
+    stack = np.asarray(stack)
+    alpha, tx, ty = [np.asarray(v, dtype=dtype).reshape(-1, 1, 1) for v in (alpha, tx, ty)]
+    out = np.empty(stack.shape, dtype=dtype)
+    chunk = max(1, CHUNK_PIXELS // (stack.shape[1] * stack.shape[2]))
+    for i in range(0, len(stack), chunk):
+        part = slice(i, i + chunk)
+        images = np.asarray(stack[part], dtype=dtype)
+        if np.any(alpha[part]):
+            images = _rotate_stack(images, alpha[part])
+        if np.any(tx[part]) or np.any(ty[part]):
+            images = _shift_stack(images, tx[part], ty[part])
+        out[part] = images
+    return out
+
+#rotate each image of a stack by its own angle, by bilinear interpolation. Pixels mapped from outside the image are zero
+def _rotate_stack(stack, alpha):
+    n, ny, nx = stack.shape
+    cy, cx = ny // 2, nx // 2
+    a = np.deg2rad(alpha)
+    c, s = np.cos(a), np.sin(a)
+    y = (np.arange(ny, dtype=stack.dtype) - cy).reshape(1, ny, 1)
+    x = (np.arange(nx, dtype=stack.dtype) - cx).reshape(1, 1, nx)
+    #inverse mapping from each output pixel to the input pixel it is sampled from. Coordinates are clamped into a zero
+    #border around each image (one pixel before, two after), so samples from outside the image interpolate to zero
+    iy = np.clip(c * y + s * x + cy, -1, ny)
+    ix = np.clip(-s * y + c * x + cx, -1, nx)
+    y0, x0 = np.floor(iy), np.floor(ix)
+    wy, wx = iy - y0, ix - x0
+    padded = np.zeros((n, ny + 3, nx + 3), dtype=stack.dtype)
+    padded[:, 1:ny + 1, 1:nx + 1] = stack
+    flat = padded.reshape(-1)
+    row = nx + 3
+    index = (np.arange(n, dtype=np.intp) * (ny + 3) * row).reshape(n, 1, 1)
+    index = index + (y0.astype(np.intp) + 1) * row + (x0.astype(np.intp) + 1)
+
+    top = flat[index]
+    top += wx * (flat[index + 1] - top)
+    bottom = flat[index + row]
+    bottom += wx * (flat[index + row + 1] - bottom)
+    bottom -= top
+    bottom *= wy
+    top += bottom
+    return top
+
+#translate each image of a stack by its own sub-pixel shift, by multiplying its Fourier transform with a phase ramp
+def _shift_stack(stack, tx, ty):
+    ny, nx = stack.shape[1:]
+    ky = np.fft.fftfreq(ny).astype(stack.dtype).reshape(1, ny, 1)
+    kx = np.fft.rfftfreq(nx).astype(stack.dtype).reshape(1, 1, nx // 2 + 1)
+    ramp = np.exp(-2j * np.pi * (ky * ty + kx * tx)).astype(np.result_type(stack.dtype, np.complex64))
+    ft = fft.rfft2(stack)
+    ft *= ramp
+    return fft.irfft2(ft, s=(ny, nx))
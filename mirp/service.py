@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+service.py provides an optional long-lived MiRP server on the local node, and the client shim used by the mirp_* scripts.
+The server keeps NumPy, SciPy and matplotlib loaded, and holds an LRU cache of parsed and grouped starfiles, so that jobs
+launched by RELION do not pay the import cost or parse a starfile that an earlier job already parsed. Clients send their
+command line over a Unix socket and stream the job output back. When no server is running, scripts run in their own process.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+import traceback
+import tempfile
+import signal
+import socket
+import stat
+import json
+import sys
+import os
+
+mirp_dir = os.path.dirname(os.path.abspath(__file__))
+#scripts that the server will run
+SCRIPTS = ['mirp_pf_sorting', 'mirp_initial_seam', 'mirp_seam_check']
+#set in the server process, so that scripts run by the server do not send themselves to it
+IN_SERVER = False
+
+
+#default socket location, which can be set with the MIRP_SOCKET environment variable. Otherwise the socket is in the user's
+#runtime folder ($XDG_RUNTIME_DIR) if there is one, or in mirp-<uid> in the temporary folder
+def default_socket():
+    if 'MIRP_SOCKET' in os.environ:
+        return os.environ['MIRP_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'mirp.sock')
+    return os.path.join(tempfile.gettempdir(), 'mirp-%i' % os.getuid(), 'mirp.sock')
+
+#whether path is of the given type (e.g. stat.S_ISDIR), not a symbolic link, owned by the user, and not accessible to anyone
+#else. Another user able to create the socket or its folder could otherwise run jobs given by this user's scripts
+def _private(path, is_type):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return is_type(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+#send a message (dictionary) as one line of JSON
+def _send(f, message):
+    f.write((json.dumps(message) + '\n').encode())
+    f.flush()
+
+
+###### Client ######
+#run the current script on the MiRP server if one is running, and exit with its exit status. Returns (so that the script
+#runs in this process) if there is no server, the server can not be reached, the socket or its folder is not private to the
+#user, or MIRP_NO_SERVER is set
+def run_on_server(script=None, path=None):
+    if IN_SERVER or os.environ.get('MIRP_NO_SERVER'):
+        return
+    path = path or default_socket()
+    if not (_private(os.path.dirname(os.path.abspath(path)), stat.S_ISDIR) and _private(path, stat.S_ISSOCK)):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return
+
+    script = script or os.path.basename(sys.argv[0])
+    with sock, sock.makefile('rwb') as f:
+        _send(f, {'script': script, 'argv': sys.argv[1:], 'cwd': os.getcwd()})
+        #stream the job output until its exit status arrives
+        for line in f:
+            message = json.loads(line)
+            if 'exit' in message:
+                sys.exit(message['exit'])
+            stream = sys.stdout if message['stream'] == 'stdout' else sys.stderr
+            stream.write(message['data'])
+            stream.flush()
+    sys.stderr.write('Error: lost connection to the MiRP server at %s\n' % path)
+    sys.exit(1)
+
+
+###### Server ######
+#least recently used cache of parsed starfiles, holding at most max_items
+class DatasetCache:
+
+    def __init__(self, max_items=4):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+#file-like object sending everything written to it to the client as one output stream
+class _StreamWriter:
+
+    def __init__(self, f, stream):
+        self._f = f
+        self._stream = stream
+
+    def write(self, data):
+        if data:
+            _send(self._f, {'stream': self._stream, 'data': data})
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+#run one job sent by a client: the script is run as __main__ in the job's working directory, with its output sent back
+def _run_job(f, job):
+    import runpy
+    if job['script'] not in SCRIPTS:
+        _send(f, {'stream': 'stderr', 'data': 'Error: the MiRP server can only run %s\n' % ', '.join(SCRIPTS)})
+        return 2
+    stdout, stderr, argv, cwd = sys.stdout, sys.stderr, sys.argv, os.getcwd()
+    sys.stdout, sys.stderr = _StreamWriter(f, 'stdout'), _StreamWriter(f, 'stderr')
+    sys.argv = [os.path.join(mirp_dir, job['script'])] + job['argv']
+    status = 0
+    try:
+        os.chdir(job['cwd'])
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            sys.stderr.write('%s\n' % e.code)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr, sys.argv = stdout, stderr, argv
+        os.chdir(cwd)
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+    return status
+
+#serve MiRP jobs on a Unix socket, one at a time, until interrupted. Libraries are loaded before the first job, and parsed
+#starfiles are kept in an LRU cache of cache_size datasets
+def serve(path=None, cache_size=4):
+    global IN_SERVER
+    IN_SERVER = True
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    sys.path.insert(0, mirp_dir)
+    import microtubules
+    microtubules.dataset_cache = DatasetCache(cache_size)
+    #import the heavy libraries now, rather than in the first job
+    for lib in (microtubules.np, microtubules.stats, microtubules.plt):
+        lib._load()
+
+    path = path or default_socket()
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    assert _private(folder, stat.S_ISDIR), 'The socket folder %s must be owned by you, and not accessible to other users.' % folder
+    if os.path.exists(path):
+        #remove the socket of a server that is no longer running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            assert False, 'A MiRP server is already running on %s' % path
+        except OSError:
+            os.remove(path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    print('MiRP server listening on %s' % path)
+    sys.stdout.flush()
+    #stop on SIGTERM as on an interrupt, so that the socket is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile('rwb') as f:
+                try:
+                    line = f.readline()
+                    if not line:
+                        #a connection without a job, such as the check for a running server
+                        continue
+                    job = json.loads(line)
+                    status = _run_job(f, job)
+                    _send(f, {'exit': status})
+                except (OSError, ValueError):
+                    #the client went away, or sent an invalid job
+                    traceback.print_exc()
+                    continue
+                cache = microtubules.dataset_cache
+                print('%s %s: exit %i (cache: %i datasets, %i hits, %i misses)' % (job['script'], ' '.join(job['argv']), status,
+                      len(cache), cache.hits, cache.misses))
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
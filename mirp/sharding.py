@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+sharding.py provides functions for splitting a _data.star file into shards that can be processed by MiRP independently
+(e.g. on separate cluster nodes), and for merging the MiRP outputs of the shards so that they match a single run.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import starfileIO
+import microtubules
+import helper_fns
+import collections
+import os
+
+np = helper_fns.np
+
+#MiRP output particle starfiles, which are merged by concatenating the shards in order
+PARTICLE_OUTPUTS = ['1%ipf_data.star' % i for i in range(1, 7)] + ['rotCorrected_data.star', 'xyCorrected_data.star', 'seamCorrected_data.star']
+
+
+###### Sharding ######
+#split the particles of a starfile into k shards of whole micrographs (so no microtubule is split), balanced by particle number.
+#each shard is a contiguous range of micrographs in sorted order, so that concatenating the shard outputs in order gives the
+#same order as processing the whole starfile at once. Returns the names of the shard starfiles written
+def shard_starfile(starfile_in, outdir, k):
+    star = starfileIO.Starfile(starfile_in)
+    star.read_star()
+    star.sort_loop_datablock('data_particles', 'rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst')
+    particles = star.get_datablock('data_particles')
+    _, starts = helper_fns.run_codes(particles['rlnMicrographName'])
+    total = star.get_loopdatablock_len('data_particles')
+    k = max(1, min(k, len(starts)))
+
+    #cut at the micrograph boundary closest to each 1/k of the particles: the first boundary at or after it, or the one before
+    #that if it is nearer (but never the start of the first micrograph)
+    bounds = np.append(starts, total)
+    targets = np.arange(1, k) * total / float(k)
+    after = np.clip(np.searchsorted(bounds, targets), 1, len(bounds) - 1)
+    before = np.maximum(after - 1, 1)
+    cuts = np.where(targets - bounds[before] < bounds[after] - targets, bounds[before], bounds[after])
+    cuts = np.unique(np.concatenate(([0], cuts, [total])))
+
+    os.makedirs(outdir, exist_ok=True)
+    names = []
+    for i, (lo, hi) in enumerate(zip(cuts[:-1], cuts[1:])):
+        shard = starfileIO.Starfile('%s/shard%03i_data.star' % (outdir, i + 1))
+        for key in star._datablocks:
+            if key == 'data_particles':
+                shard.add_datablock(key, collections.OrderedDict((label, data[lo:hi]) for label, data in particles.items()))
+            else:
+                shard.add_datablock(key, star.get_datablock(key))
+        shard.write_star(shard.starfile)
+        names.append(shard.starfile)
+    return names
+
+
+###### Merging ######
+#read a starfile from each shard output folder that has it
+def _read_shards(shard_dirs, name):
+    stars = []
+    for d in shard_dirs:
+        path = '%s/%s' % (d, name)
+        if os.path.exists(path):
+            star = starfileIO.Starfile(path)
+            star.read_star()
+            stars.append(star)
+    return stars
+
+#concatenate the particles of a MiRP output starfile from each shard, in shard order
+def merge_particles(shard_dirs, name, outdir):
+    stars = _read_shards(shard_dirs, name)
+    if not stars:
+        return None
+    merged = stars[0]
+    for star in stars[1:]:
+        merged.add_loop_data('data_particles', star.get_datablock('data_particles'))
+    merged.write_star('%s/%s' % (outdir, name))
+    return '%s/%s' % (outdir, name)
+
+#sum the tube, particle, removed tube and class counts of each shard, and recalculate the protofilament number percentages
+def merge_pf_number_stats(shard_dirs, outdir):
+    stars = _read_shards(shard_dirs, 'pf_number_sorting_stats.star')
+    if not stars:
+        return None
+    totals = collections.Counter()
+    uncorr_class, corr_class = collections.Counter(), collections.Counter()
+    for star in stars:
+        for label in ('rlnTotalNumberTubes', 'mirpTotalNumberTubes', 'rlnTotalNumberParticles', 'mirpTotalNumberParticles',
+                      'mirpTooShortTubes', 'mirpLowConfidenceTubes'):
+            totals[label] += star.get_entry('data_general', label)
+        pfnums = star.get_entry('data_percent_protofilament_number', 'mtProtofilamentNumber')
+        for pf, u, c in zip(pfnums, star.get_entry('data_percent_protofilament_number', 'rlnClassCount'),
+                            star.get_entry('data_percent_protofilament_number', 'mirpClassCount')):
+            uncorr_class[pf - 10] += u
+            corr_class[pf - 10] += c
+    stats = microtubules.pf_number_stats(totals['rlnTotalNumberTubes'], totals['mirpTotalNumberTubes'], totals['rlnTotalNumberParticles'],
+                                         totals['mirpTotalNumberParticles'], uncorr_class, corr_class, totals['mirpTooShortTubes'],
+                                         totals['mirpLowConfidenceTubes'])
+    stats.write_star('%s/pf_number_sorting_stats.star' % outdir)
+    return '%s/pf_number_sorting_stats.star' % outdir
+
+#sum the particle count in each seam class and the low confidence tubes of each shard, and recalculate the percentages and distribution plot
+def merge_seam_stats(shard_dirs, outdir):
+    stars = _read_shards(shard_dirs, 'seamcorrection_stats.star')
+    if not stars:
+        return None
+    distribution = collections.Counter()
+    low_confidence = 0
+    for star in stars:
+        low_confidence += star.get_entry('data_general', 'mirpLowConfidenceTubes')
+        db = star.get_datablock('data_seam_class_distribution')
+        for seamclass, count in zip(db['seamClassNumber'], db['seamClassCount']):
+            distribution[seamclass] += count
+    stats = microtubules.seam_stats(distribution, low_confidence)
+    stats.write_star('%s/seamcorrection_stats.star' % outdir)
+    microtubules.plot_seam_stats(stats, '%s/seamclass_distribution.pdf' % outdir)
+    return '%s/seamcorrection_stats.star' % outdir
+
+#concatenate the per-microtubule confidence of each shard, in shard order, and replot the confidence histogram
+def merge_confidence(shard_dirs, outdir):
+    stars = _read_shards(shard_dirs, 'confidence.star')
+    if not stars:
+        return None
+    confidence = []
+    for star in stars:
+        confidence += star.get_entry('data_confidence', 'mirpConfidence')
+    cutoff = stars[0].get_entry('data_general', 'mirpConfidenceCutoff')
+    microtubules.confidence_stats(confidence, cutoff).write_star('%s/confidence.star' % outdir)
+    microtubules.plot_confidence(confidence, cutoff, '%s/confidence.pdf' % outdir)
+    return '%s/confidence.star' % outdir
+
+#merge all MiRP outputs found in the shard output folders (given in shard order). Returns the names of the merged files
+def merge_outputs(shard_dirs, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    merged = [merge_particles(shard_dirs, name, outdir) for name in PARTICLE_OUTPUTS]
+    merged += [merge_pf_number_stats(shard_dirs, outdir), merge_seam_stats(shard_dirs, outdir), merge_confidence(shard_dirs, outdir)]
+    return [m for m in merged if m]
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+tube_index.py provides a persistent on-disk index of the microtubules in a starfile. For every micrograph and microtubule
+(rlnMicrographName, rlnHelicalTubeID), the index records the byte ranges of its particle rows in the starfile, so that one
+microtubule can be read from a large starfile without reading the rest. The index is an SQLite database kept next to the
+starfile, and is rebuilt when the starfile changes.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+from collections import OrderedDict
+import external_sort
+import helper_fns
+import sqlite3
+import os
+
+#increase when the index format changes, so that old indexes are rebuilt
+VERSION = 1
+
+
+#name of the index file of a starfile
+def index_name(starfile):
+    return '%s.mirpidx' % starfile
+
+#size and modification time of a starfile, stored in its index to detect changes
+def _stamp(starfile):
+    stat = os.stat(starfile)
+    return '%i %i %i' % (VERSION, stat.st_size, stat.st_mtime_ns)
+
+#split lines of a starfile into fields, skipping blank lines and comments (as helper_fns.readfile)
+def _fields(lines):
+    for line in lines:
+        fields = line.split()
+        if fields and not fields[0].startswith('#'):
+            yield fields
+
+#scan a starfile, and return the byte offset of the first particle row, and the byte ranges of the rows of each microtubule as
+#(micrograph, tube ID, start, stop). Consecutive rows of the same microtubule are merged into one range
+def scan_starfile(starfile, datablock_id='data_particles'):
+    ranges = []
+    head_end = None
+    labels = []
+    inblock = False
+    last = None
+    pos = 0
+    with open(starfile, 'rb') as f:
+        for line in f:
+            start, pos = pos, pos + len(line)
+            fields = line.split()
+            if not fields or fields[0].startswith(b'#'):
+                continue
+            if fields[0].startswith(b'data_'):
+                inblock = fields[0].decode() == datablock_id
+                last = None
+            elif not inblock or fields[0] == b'loop_':
+                continue
+            elif fields[0].startswith(b'_'):
+                labels.append(fields[0][1:].decode())
+            else:
+                if head_end is None:
+                    head_end = start
+                    mgph_ix, tube_ix = labels.index('rlnMicrographName'), labels.index('rlnHelicalTubeID')
+                key = (fields[mgph_ix].decode(), helper_fns.literal_eval(fields[tube_ix].decode()))
+                if last is not None and last[:2] == key and last[3] == start:
+                    last[3] = pos
+                else:
+                    last = [key[0], key[1], start, pos]
+                    ranges.append(last)
+    assert labels, 'No %s datablock found in %s' % (datablock_id, starfile)
+    return head_end if head_end is not None else pos, ranges
+
+#build the index of a starfile. The index is written to a temporary file and renamed into place, so that it is never seen
+#incomplete. Returns the index file name
+def build_index(starfile, index_file=None):
+    index_file = index_file or index_name(starfile)
+    stamp = _stamp(starfile)
+    head_end, ranges = scan_starfile(starfile)
+    tmp = '%s.%i.tmp' % (index_file, os.getpid())
+    db = sqlite3.connect(tmp)
+    with db:
+        db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value)')
+        db.execute('CREATE TABLE rows (micrograph TEXT, tube INTEGER, start INTEGER, stop INTEGER)')
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [('stamp', stamp), ('head_end', head_end)])
+        db.executemany('INSERT INTO rows VALUES (?, ?, ?, ?)', ranges)
+        db.execute('CREATE INDEX tube_rows ON rows (micrograph, tube)')
+    db.close()
+    os.replace(tmp, index_file)
+    return index_file
+
+#return the stamp stored in an index file, or None if there is no (readable) index
+def read_stamp(index_file):
+    if not os.path.exists(index_file):
+        return None
+    db = sqlite3.connect(index_file)
+    try:
+        return db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+
+
+#random access to the microtubules of a starfile through its index, which is built (or rebuilt, if the starfile has changed) if needed
+class TubeIndex:
+
+    def __init__(self, starfile, index_file=None):
+        self.starfile = starfile
+        self.index_file = index_file or index_name(starfile)
+        self._head = None
+        if read_stamp(self.index_file) != _stamp(starfile):
+            build_index(starfile, self.index_file)
+        self._db = sqlite3.connect(self.index_file)
+        self.head_end = self._db.execute("SELECT value FROM meta WHERE key = 'head_end'").fetchone()[0]
+
+    #the datablocks of the starfile before the particle rows, with the particle labels (see external_sort.read_header)
+    def head(self):
+        if self._head is None:
+            with open(self.starfile, 'rb') as f:
+                text = f.read(self.head_end).decode()
+            self._head = external_sort.read_header(self.starfile, lines=_fields(text.splitlines()))
+        return self._head
+
+    #return the tube IDs of the microtubules in a micrograph
+    def tube_ids(self, micrograph):
+        rows = self._db.execute('SELECT DISTINCT tube FROM rows WHERE micrograph = ? ORDER BY tube', (str(micrograph),))
+        return [tube for tube, in rows]
+
+    #return one microtubule (dictionary of lists, sorted by track length as in Microtubules), or None if it is not in the starfile
+    def get_tube(self, micrograph, tube_id):
+        ranges = self._db.execute('SELECT start, stop FROM rows WHERE micrograph = ? AND tube = ? ORDER BY start',
+                                  (str(micrograph), tube_id)).fetchall()
+        if not ranges:
+            return None
+        labels = list(self.head().get_labels('data_particles'))
+        rows = []
+        with open(self.starfile, 'rb') as f:
+            for start, stop in ranges:
+                f.seek(start)
+                rows += _fields(f.read(stop - start).decode().splitlines())
+        rows = [[helper_fns.literal_eval(val) for val in fields] for fields in rows]
+        rows.sort(key=lambda row: row[labels.index('rlnHelicalTrackLengthAngst')])
+        return OrderedDict((label, list(data)) for label, data in zip(labels, zip(*rows)))
+
+    def close(self):
+        self._db.close()
+
+    def __repr__(self):
+        return 'TubeIndex(%s)' % self.starfile
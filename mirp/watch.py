@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiRP - a microtubule RELION-based pipeline for cryo-EM image processing.
+watch.py provides functions for following a running Class3D job, so that MiRP voting is run on the _data.star file of each
+iteration as soon as it is written, with a summary of every iteration so far.
+"""
+
+__author__ = 'Alexander D. Cook & Joseph Atherton'
+__license__ = 'GPLv3'
+__version__ = '2.0'
+
+
+import microtubules
+import starfileIO
+import glob
+import time
+import re
+import os
+
+#files written by RELION when a job ends
+FINISHED = ('RELION_JOB_EXIT_SUCCESS', 'RELION_JOB_EXIT_FAILURE', 'RELION_JOB_EXIT_ABORTED')
+ITERATION = re.compile(r'_it(\d+)_data\.star$')
+
+
+#return (iteration, filename) for the _data.star file of each iteration of a Class3D job, in iteration order
+def iteration_files(job_dir):
+    files = []
+    for f in glob.glob(os.path.join(job_dir, 'run_*it*_data.star')):
+        match = ITERATION.search(f)
+        if match:
+            files.append((int(match.group(1)), f))
+    return sorted(files)
+
+#yield (iteration, filename) for each iteration of a Class3D job as it is written, until the job finishes, or no new iteration
+#has been written for timeout seconds. A file is ready when a later iteration exists, the job has finished, or its size has not
+#changed since the last poll
+def watch_iterations(job_dir, poll=5, timeout=None):
+    done = set()
+    sizes = {}
+    last = time.time()
+    while True:
+        finished = any(os.path.exists(os.path.join(job_dir, f)) for f in FINISHED)
+        files = iteration_files(job_dir)
+        for ix, (iteration, f) in enumerate(files):
+            if f in done:
+                continue
+            size = os.path.getsize(f)
+            if not (finished or ix < len(files) - 1 or sizes.get(f) == size):
+                sizes[f] = size
+                break
+            done.add(f)
+            last = time.time()
+            yield iteration, f
+        if finished and len(done) == len(files):
+            return
+        if timeout is not None and time.time() - last > timeout:
+            return
+        time.sleep(poll)
+
+#add a row for an iteration to the watch summary starfile: the number of microtubules voted on, their mean confidence,
+#and the percentage at or above the confidence cutoff
+def update_summary(job_path, iteration, confidence):
+    name = '%s/watch_summary.star' % job_path
+    values = confidence.get_entry('data_confidence', 'mirpConfidence')
+    cutoff = float(confidence.get_entry('data_general', 'mirpConfidenceCutoff'))
+    row = {'rlnCurrentIteration': iteration,
+           'mirpTotalNumberTubes': len(values),
+           'mirpMeanConfidence': sum(values) / len(values) if values else 0,
+           'mirpPercentAboveCutoff': sum(c >= cutoff for c in values) / len(values) * 100 if values else 0}
+    summary = starfileIO.Starfile(name)
+    if os.path.exists(name):
+        summary.read_star()
+        summary.add_loop_data('data_iterations', row)
+    else:
+        summary.add_datablock('data_iterations', {k: [v] for k, v in row.items()})
+    summary.write_star(name)
+    return row
+
+#run vote(mts) on each iteration of a Class3D job as it is written. Microtubules are read from the first iteration, and later
+#iterations reuse their grouping. Per-microtubule plots are off unless plot_options (see Microtubules.set_plot_options) are given.
+#max_memory, pipeline and compact are as for Microtubules, and apply to every iteration
+def watch_job(job_dir, job_path, vote, poll=5, timeout=None, plot_options=None, max_memory=None, pipeline=None, compact=False):
+    mts = None
+    for iteration, starfile in watch_iterations(job_dir, poll, timeout):
+        start = time.time()
+        if mts is None:
+            mts = microtubules.Microtubules(starfile, job_path, max_memory, pipeline, compact)
+            if plot_options:
+                mts.set_plot_options(**plot_options)
+            else:
+                mts.set_plot_options(None)
+        else:
+            mts.load_iteration(starfile)
+        vote(mts)
+        row = update_summary(job_path, iteration, mts.confidence)
+        print('Iteration %i: %i microtubules, mean confidence %.1f, %.1f%% above cutoff (%.1f s)' % (iteration, row['mirpTotalNumberTubes'],
+              row['mirpMeanConfidence'], row['mirpPercentAboveCutoff'], time.time() - start))
+    return mts